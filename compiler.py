@@ -18,6 +18,37 @@ parser.add_option("-c", "--casadi", dest="casadi_folder",
                   help="CasADi installation folder")
 parser.add_option("-f", "--flatten_only",
                   action="store_true", dest="flatten_only")
+parser.add_option("--flat_cache", dest="flat_cache_folder",
+                  help="Folder in which to cache flattened models")
+parser.add_option("--vectorize_arrays",
+                  action="store_true", dest="vectorize_arrays",
+                  help="Keep the equations of arrays of component instances as a single for loop")
+parser.add_option("--prune_dead_elements",
+                  action="store_true", dest="prune_dead_elements",
+                  help="Remove unreferenced parameters, constants, protected variables and functions")
+parser.add_option("--map_mode", dest="map_mode", default="serial",
+                  help="Map mode of the loop bodies of for loops: serial, openmp or thread")
+parser.add_option("--map_threads", dest="map_threads", type="int",
+                  help="Maximum number of threads of the thread map mode")
+parser.add_option("--map_threshold", dest="map_threshold", type="int", default=0,
+                  help="Map for loops with fewer iterations serially")
+parser.add_option("--release_expressions",
+                  action="store_true", dest="release_expressions",
+                  help="Release the conversions of expressions once their equation has been converted")
+parser.add_option("--cse",
+                  action="store_true", dest="cse",
+                  help="Convert structurally identical expressions to CasADi once")
+parser.add_option("--instance_functions",
+                  action="store_true", dest="instance_functions",
+                  help="Map a single function over the equations of repeated component instances")
+parser.add_option("--expand_sx",
+                  action="store_true", dest="expand_sx",
+                  help="Evaluate the residual and metadata functions in SX where possible")
+parser.add_option("--streaming",
+                  action="store_true", dest="streaming",
+                  help="Generate the CasADi model while flattening, one equation at a time")
+parser.add_option("--profile_flattening", dest="flatten_profile",
+                  help="With --flatten_only, report the cost of flattening per class, and write it to the given JSON file")
 parser.add_option("-v", "--verbose",
                   action="store_true", dest="verbose")
 (options, args) = parser.parse_args()
@@ -32,6 +63,7 @@ logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO)
 
 # Import rest of pymola
 from pymola import parser, tree, ast
+from pymola.profiler import FlatteningProfiler
 
 # Compile
 if options.flatten_only:
@@ -49,8 +81,15 @@ if options.flatten_only:
 
     logger.info("Flattening")
 
-    _ast = tree.flatten(_ast, ast.ComponentRef(name=model_name))
+    profiler = FlatteningProfiler() if options.flatten_profile is not None else None
+    _ast = tree.flatten(_ast, ast.ComponentRef(name=model_name), cache_folder=options.flat_cache_folder,
+                        vectorize_arrays=bool(options.vectorize_arrays), profiler=profiler,
+                        prune_dead_elements=bool(options.prune_dead_elements))
     print(_ast)
+
+    if profiler is not None:
+        print(profiler.report())
+        profiler.save(options.flatten_profile)
 else:
     # Set CasADi installation folder
     if options.casadi_folder is not None:
@@ -67,7 +106,18 @@ else:
          'eliminable_variable_expression': r'_\w+',
          'detect_aliases': True,
          'expand': False,
-         'cache': True}
+         'cache': True,
+         'flat_cache_folder': options.flat_cache_folder,
+         'vectorize_arrays': bool(options.vectorize_arrays),
+         'prune_dead_elements': bool(options.prune_dead_elements),
+         'streaming': bool(options.streaming),
+         'cse': bool(options.cse),
+         'release_expressions': bool(options.release_expressions),
+         'instance_functions': bool(options.instance_functions),
+         'expand_sx': bool(options.expand_sx),
+         'map_mode': options.map_mode,
+         'map_threads': options.map_threads,
+         'map_threshold': options.map_threshold}
 
     model = transfer_model(model_folder, model_name, compiler_options)
     print(model)
@@ -79,7 +79,8 @@ class Node(object):
         elif isinstance(var, dict):
             res = {key: cls.to_json(var[key]) for key in var.keys()}
         elif isinstance(var, Node):
-            res = {key: cls.to_json(var.__dict__[key]) for key in var.__dict__.keys()}
+            # Attributes starting with an underscore hold bookkeeping, not tree data
+            res = {key: cls.to_json(var.__dict__[key]) for key in var.__dict__.keys() if not key.startswith('_')}
         elif isinstance(var, Visibility):
             res = str(var)
         else:
@@ -384,6 +385,9 @@ class Class(Node):
         self.within = []  # type: List[ComponentRef]
         super().__init__(**kwargs)
 
+        # Memoized values of structural parameters, filled in on demand
+        self._constant_evaluator = None
+
 
 class File(Node):
     """
@@ -395,6 +399,82 @@ class File(Node):
         self.classes = OrderedDict()  # type: OrderedDict[str, Class]
         super().__init__(**kwargs)
 
+        # Structural information, filled in when flattening
+        self._dependency_graph = None
+        self._incidence = None
+        self._initial_incidence = None
+        self._pruned = None
+        self._names = None
+
+    @property
+    def dependency_graph(self):
+        """
+        Dependencies of the component instances of a flattened model on the source classes
+        """
+        return self._dependency_graph
+
+    @property
+    def names(self):
+        """
+        Table of the symbol names of a flattened model, by symbol id
+        """
+        return self._names
+
+    @property
+    def incidence(self):
+        """
+        Equation-variable incidence of the equations of a flattened model
+        """
+        return self._incidence
+
+    @property
+    def initial_incidence(self):
+        """
+        Equation-variable incidence of the initial equations of a flattened model
+        """
+        return self._initial_incidence
+
+    @property
+    def pruned(self):
+        """
+        Names of the symbols and functions removed from a flattened model as unreferenced
+        """
+        return self._pruned
+
+
+# The node types that can appear as direct children of each node type.  Tree
+# walks use this to skip the sub-trees in which a listener has nothing to do.
+# Node types that are not listed here can contain any node type.
+EXPRESSION_TYPES = (Primary, Array, Slice, ComponentRef, Expression, IfExpression)
+EQUATION_TYPES = (Equation, IfEquation, ForEquation, ConnectClause)
+STATEMENT_TYPES = (AssignmentStatement, IfStatement, ForStatement)
+
+CHILD_TYPES = {
+    Primary: (),
+    Array: EXPRESSION_TYPES,
+    Slice: EXPRESSION_TYPES,
+    ComponentRef: EXPRESSION_TYPES,
+    Expression: EXPRESSION_TYPES,
+    IfExpression: EXPRESSION_TYPES,
+    # The equations for symbol values refer to the symbols themselves
+    Equation: EXPRESSION_TYPES + (Symbol,),
+    IfEquation: EXPRESSION_TYPES + EQUATION_TYPES,
+    ForIndex: EXPRESSION_TYPES,
+    ForEquation: (ForIndex,) + EQUATION_TYPES,
+    ConnectClause: (ComponentRef,),
+    AssignmentStatement: EXPRESSION_TYPES + (Symbol,),
+    IfStatement: EXPRESSION_TYPES + STATEMENT_TYPES,
+    ForStatement: (ForIndex,) + STATEMENT_TYPES,
+    Symbol: EXPRESSION_TYPES + (ClassModification,),
+    ComponentClause: EXPRESSION_TYPES + (Symbol,),
+    ImportAsClause: (ComponentRef,),
+    ImportFromClause: (ComponentRef,),
+    ElementModification: EXPRESSION_TYPES + (ClassModification,),
+    ShortClassDefinition: (ComponentRef, ClassModification),
+    ClassModification: (ElementModification, ComponentClause, ShortClassDefinition),
+    ExtendsClause: (ComponentRef, ClassModification),
+}  # type: Dict[type, tuple]
+
 
 class Collection(Node):
     """
@@ -409,6 +489,15 @@ class Collection(Node):
         # TODO: Should be directly build the class_lookup, or wait until the first call to find_class?
         self._class_lookup = None
 
+        # The full names of all classes found by find_class are added to each of these sets
+        self._lookup_logs = []
+
+        # Profiler measuring the cost of flattening, if any
+        self._profiler = None
+
+        # Flattened functions, by fully scoped name, shared by all instances while flattening
+        self._flat_functions = None
+
     def _build_class_lookup_for_class(self, c, within):
         if within:
             full_name = ComponentRef.concatenate(within, ComponentRef(name=c.name))
@@ -491,6 +580,9 @@ class Collection(Node):
             else:
                 raise ClassNotFoundError("Could not find class {}".format(component_ref))
 
+        for lookup_log in self._lookup_logs:
+            lookup_log.add(prev_tuple)
+
         if return_ref:
             return c, ComponentRef.from_tuple(prev_tuple)
         else:
@@ -73,6 +73,15 @@ class InvalidCacheError(Exception):
     pass
 
 
+# Compiler options that do not affect the compiled model, and are therefore
+# not compared against those the cache was generated with.
+CACHE_INSENSITIVE_OPTIONS = {'cache', 'mtime_check', 'check_balanced', 'verbose', 'flat_cache_folder'}
+
+
+def _cached_options(compiler_options: Dict[str, str]) -> Dict[str, str]:
+    return {k: v for k, v in compiler_options.items() if k not in CACHE_INSENSITIVE_OPTIONS}
+
+
 class ObjectData:
     # This is not a named tuple, since we need read/write access to 'library'
     def __init__(self, key, library):
@@ -97,7 +106,7 @@ def _compile_model(model_folder: str, model_name: str, compiler_options: Dict[st
     # Compile
     logger.info("Generating CasADi model")
 
-    model = generator.generate(tree, model_name)
+    model = generator.generate(tree, model_name, compiler_options)
     if compiler_options.get('check_balanced', True):
         model.check_balanced()
 
@@ -108,7 +117,7 @@ def _compile_model(model_folder: str, model_name: str, compiler_options: Dict[st
 
     return model
 
-def _save_model(model_folder: str, model_name: str, model: Model):
+def _save_model(model_folder: str, model_name: str, model: Model, compiler_options: Dict[str, str]={}):
     # Compile shared libraries
     if os.name == 'posix':
         compiler_flags = ['-O2', '-fPIC']
@@ -117,6 +126,16 @@ def _save_model(model_folder: str, model_name: str, model: Model):
         compiler_flags = ['/O2', '/wd4101']  # Shut up unused local variable warnings.
         linker_flags = ['/DLL']
 
+    # Loops mapped in OpenMP mode are generated as OpenMP parallel loops
+    map_modes = set(compiler_options.get('map_modes', {}).values())
+    map_modes.add(compiler_options.get('map_mode', 'serial'))
+    if 'openmp' in map_modes:
+        if os.name == 'posix':
+            compiler_flags.append('-fopenmp')
+            linker_flags.append('-fopenmp')
+        else:
+            compiler_flags.append('/openmp')
+
     objects = {'dae_residual': ObjectData('dae_residual', ''), 'initial_residual': ObjectData('initial_residual', ''), 'variable_metadata': ObjectData('variable_metadata', '')}
     for o, d in objects.items():
         f = getattr(model, o + '_function')
@@ -162,6 +181,9 @@ def _save_model(model_folder: str, model_name: str, model: Model):
         # Store version
         db['version'] = __version__
 
+        # Store the options the model was compiled with
+        db['compiler_options'] = _cached_options(compiler_options)
+
         # Include references to the shared libraries
         for o, d in objects.items():
             db[d.key] = d.library
@@ -204,6 +226,9 @@ def _load_model(model_folder: str, model_name: str, compiler_options: Dict[str,
         if db['library_os'] != os.name:
             raise InvalidCacheError('Cache generated for incompatible OS')
 
+        if db.get('compiler_options', None) != _cached_options(compiler_options):
+            raise InvalidCacheError('Cache generated with different compiler options')
+
         # Include references to the shared libraries
         for o, d in objects.items():
             f = ca.external(o, db[d.key])
@@ -268,7 +293,7 @@ def transfer_model(model_folder: str, model_name: str, compiler_options: Dict[st
             return _load_model(model_folder, model_name, compiler_options)
         except (FileNotFoundError, InvalidCacheError):
             model = _compile_model(model_folder, model_name, compiler_options)
-            _save_model(model_folder, model_name, model)
+            _save_model(model_folder, model_name, model, compiler_options)
             return model
     else:
         return _compile_model(model_folder, model_name, compiler_options)
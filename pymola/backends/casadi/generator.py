@@ -1,15 +1,19 @@
 from __future__ import print_function, absolute_import, division, unicode_literals
 
+import hashlib
+import json
 import logging
-from collections import namedtuple, deque
+import re
+from collections import namedtuple, deque, OrderedDict
 
 import casadi as ca
 import numpy as np
 import itertools
-from typing import Union
+from typing import Callable, Dict, Tuple, Union
 
 from pymola import ast
-from pymola.tree import TreeWalker, TreeListener, flatten
+from pymola.tree import TreeWalker, TreeListener, ConstantEvaluationError, constant_evaluator, \
+    flatten, iter_flatten, prune_collection
 
 from .alias_relation import AliasRelation
 from .model import Model, Variable, DelayedState
@@ -17,7 +21,6 @@ from .model import Model, Variable, DelayedState
 logger = logging.getLogger("pymola")
 
 # TODO
-#  - Nested for loops
 #  - Delay operator on arbitrary expressions
 #  - Pre operator
 
@@ -36,6 +39,285 @@ OP_MAP = {'*': "__mul__",
           "max": "fmax",
           "abs": "fabs"}
 
+# Handlers converting expressions to CasADi, by operator and number of
+# operands.  Handlers registered for a number of operands of None convert
+# expressions with any number of operands, unless a handler is registered
+# for the specific number.
+OPERATORS = {}  # type: Dict[Tuple[str, Union[int, None]], Callable]
+
+# Converted Modelica functions, by fully scoped name and hash of the
+# definitions of the function and of the functions it calls, and of the
+# generator options, shared by all generators.  The least recently used functions
+# are dropped once the cache holds FUNCTION_CACHE_SIZE functions.
+FUNCTION_CACHE = OrderedDict()  # type: Dict[Tuple[str, str], ca.Function]
+FUNCTION_CACHE_SIZE = 256
+
+# Separates the keys of called functions in the key of the calling function
+CALL_SEPARATOR = '\0'
+
+
+def register_operator(op: str, n_operands: int = None, handler: Callable = None):
+    """
+    Register a handler converting expressions with an operator to CasADi.
+    Handlers take precedence over the elementary functions of MX and over
+    Modelica functions of the same name.  Without a handler, this returns a
+    decorator registering the decorated function.
+    :param op: operator, or fully scoped name of a function
+    :param n_operands: number of operands, or None for any number
+    :param handler: function taking the generator and the expression, and returning its conversion
+    :return: handler, or decorator
+    """
+    if handler is None:
+        return lambda f: register_operator(op, n_operands, f)
+    OPERATORS[op, n_operands] = handler
+    return handler
+
+
+def register_function(name: str, function: ca.Function, n_operands: int = None) -> None:
+    """
+    Convert calls to a Modelica function to calls to a CasADi function, such
+    as an external function compiled beforehand, instead of converting the
+    body of the Modelica function.
+    :param name: fully scoped name of the Modelica function
+    :param function: CasADi function to call instead
+    :param n_operands: number of operands, or None for any number
+    :return: None
+    """
+    def call(generator, tree):
+        return ca.vertcat(*function.call([generator.get_mx(operand) for operand in tree.operands]))
+    register_operator(name, n_operands, call)
+
+
+def register_method(op: str, method: str, n_operands: int) -> None:
+    """
+    Convert an operator to a call to a method of MX.
+    :param op: operator
+    :param method: name of the method of MX
+    :param n_operands: number of operands, 1 or 2
+    :return: None
+    """
+    if n_operands == 1:
+        def call(generator, tree):
+            return getattr(ca.MX(generator.get_mx(tree.operands[0])), method)()
+    else:
+        def call(generator, tree):
+            lhs = ca.MX(generator.get_mx(tree.operands[0]))
+            rhs = ca.MX(generator.get_mx(tree.operands[1]))
+            return getattr(lhs, method)(rhs)
+    register_operator(op, n_operands, call)
+
+
+for op, method in OP_MAP.items():
+    register_method(op, method, 1)
+    register_method(op, method, 2)
+
+
+@register_operator('der')
+def convert_der(generator, tree):
+    orig = generator.get_mx(tree.operands[0])
+    if orig in generator.derivative:
+        return generator.derivative[orig]
+    elif any(orig in f.indexed_symbols for f in generator.for_loops):
+        return generator.get_indexed_derivative(orig)
+    else:
+        s = ca.MX.sym("der({})".format(orig.name()), orig.sparsity())
+        generator.derivative[orig] = s
+        generator.nodes[generator.current_class][s] = s
+        return s
+
+
+@register_operator('-', 1)
+def convert_negation(generator, tree):
+    return -generator.get_mx(tree.operands[0])
+
+
+@register_operator('+')
+def convert_sum(generator, tree):
+    # N-ary sums, such as the flow balances generated by expand_connectors
+    operands = [ca.MX(generator.get_mx(operand)) for operand in tree.operands]
+    if all(operand.numel() == 1 for operand in operands):
+        return ca.sum1(ca.vertcat(*operands))
+    src = operands[0]
+    for operand in operands[1:]:
+        src = src + operand
+    return src
+
+
+@register_operator('mtimes')
+def convert_mtimes(generator, tree):
+    assert len(tree.operands) >= 2
+    src = generator.get_mx(tree.operands[0])
+    for i in tree.operands[1:]:
+        src = ca.mtimes(src, generator.get_mx(i))
+    return src
+
+
+@register_operator('transpose', 1)
+def convert_transpose(generator, tree):
+    return generator.get_mx(tree.operands[0]).T
+
+
+@register_operator('sum', 1)
+def convert_array_sum(generator, tree):
+    return ca.sum1(generator.get_mx(tree.operands[0]))
+
+
+@register_operator('linspace', 3)
+def convert_linspace(generator, tree):
+    a = generator.get_mx(tree.operands[0])
+    b = generator.get_mx(tree.operands[1])
+    n_steps = generator.get_integer(tree.operands[2])
+    return ca.linspace(a, b, n_steps)
+
+
+@register_operator('fill', 2)
+@register_operator('fill', 3)
+def convert_fill(generator, tree):
+    val = generator.get_mx(tree.operands[0])
+    shape = [generator.get_integer(operand) for operand in tree.operands[1:]]
+    return val * ca.DM.ones(*shape)
+
+
+@register_operator('zeros', 1)
+@register_operator('zeros', 2)
+def convert_zeros(generator, tree):
+    return ca.DM.zeros(*[generator.get_integer(operand) for operand in tree.operands])
+
+
+@register_operator('ones', 1)
+@register_operator('ones', 2)
+def convert_ones(generator, tree):
+    return ca.DM.ones(*[generator.get_integer(operand) for operand in tree.operands])
+
+
+@register_operator('identity', 1)
+def convert_identity(generator, tree):
+    return ca.DM.eye(generator.get_integer(tree.operands[0]))
+
+
+@register_operator('diagonal', 1)
+def convert_diagonal(generator, tree):
+    diag = generator.get_mx(tree.operands[0])
+    n = len(diag)
+    indices = list(range(n))
+    return ca.DM.triplet(indices, indices, diag, n, n)
+
+
+@register_operator('delay', 2)
+def convert_delay(generator, tree):
+    expr = generator.get_mx(tree.operands[0])
+    delay_time = generator.get_mx(tree.operands[1])
+    if not isinstance(expr, ca.MX) or not expr.is_symbolic():
+        # TODO
+        raise NotImplementedError('Currently, delay() is only supported with a variable as argument.')
+    src = ca.MX.sym('{}_delayed_{}'.format(
+        expr.name(), delay_time), *expr.size())
+    delayed_state = DelayedState(src.name(), expr.name(), delay_time)
+    generator.model.delayed_states.append(delayed_state)
+    generator.model.inputs.append(Variable(src))
+    return src
+
+
+def cse_key(value):
+    """
+    :param value: converted expression, or list of converted expressions
+    :return: key identifying the value, for common subexpression elimination
+    """
+    if isinstance(value, list):
+        return tuple(cse_key(v) for v in value)
+    elif isinstance(value, (ca.MX, ca.DM, np.ndarray)):
+        return id(value)
+    else:
+        return type(value), value
+
+
+def component_names(tree: ast.Node) -> list:
+    """
+    :param tree: tree
+    :return: names of the symbols and components referenced by the tree, other than called functions
+    """
+    names = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Symbol):
+            names.append(node.name)
+        elif isinstance(node, ast.ComponentRef):
+            names.append(node.name)
+            stack.extend(node.indices)
+            stack.extend(node.child)
+        elif isinstance(node, ast.Expression):
+            stack.extend(node.operands)
+        elif isinstance(node, ast.Node):
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return names
+
+
+def instance_signature(tree, prefix: str):
+    """
+    :param tree: tree
+    :param prefix: name of a component instance, followed by a dot
+    :return: key identifying the tree, with the instance name left out of the names of its components
+    """
+    if isinstance(tree, ast.Symbol):
+        return 'Symbol', instance_signature(tree.name, prefix)
+    elif isinstance(tree, ast.ComponentRef):
+        return ('ComponentRef', instance_signature(tree.name, prefix),
+                instance_signature(tree.indices, prefix), instance_signature(tree.child, prefix))
+    elif isinstance(tree, ast.Node):
+        return (type(tree).__name__,) + tuple((k, instance_signature(v, prefix)) for k, v in sorted(
+            tree.__dict__.items()) if not k.startswith('_'))
+    elif isinstance(tree, list):
+        return tuple(instance_signature(v, prefix) for v in tree)
+    elif isinstance(tree, dict):
+        return tuple((k, instance_signature(v, prefix)) for k, v in sorted(tree.items()))
+    elif isinstance(tree, str) and tree.startswith(prefix):
+        return '$.' + tree[len(prefix):]
+    else:
+        return tree
+
+
+def has_operator(tree: ast.Node, operator: str) -> bool:
+    """
+    :param tree: tree
+    :param operator: operator, or fully scoped name of a function
+    :return: True if the tree contains an expression with the operator
+    """
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Expression) and node.operator == operator:
+            return True
+        elif isinstance(node, ast.Node):
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return False
+
+
+def instance_prefix(names: list) -> str:
+    """
+    :param names: flattened names of components
+    :return: the name of the innermost component instance containing all of the components, followed by a dot, or ''
+    """
+    paths = [name.split('.')[:-1] for name in names if name != 'time']
+    if not paths:
+        return ''
+    prefix = paths[0]
+    for path in paths[1:]:
+        n = 0
+        while n < min(len(prefix), len(path)) and prefix[n] == path[n]:
+            n += 1
+        prefix = prefix[:n]
+    return ''.join(p + '.' for p in prefix)
+
+
 ForLoopIndexedSymbol = namedtuple('ForLoopSymbol', ['tree', 'indices'])
 
 
@@ -54,25 +336,39 @@ class ForLoop:
         self.name = i.name
         self.indexed_symbols = {}
 
-    def register_indexed_symbol(self, e, tree, index_expr=None):
-        if isinstance(index_expr, ca.MX):
-            F = ca.Function('index_expr', [self.index_variable], [index_expr])
-            # expr = lambda ar: np.array([F(a)[0] for a in ar], dtype=np.int)
-            Fmap = F.map("map", "serial", len(self.values), [], [])
-            res = Fmap.call([self.values])
-            indices = np.array(res[0].T, dtype=np.int)
+    def register_indexed_symbol(self, e, tree, index=None):
+        if index is not None:
+            indices = self.generator.get_loop_indices([index], [self])[0]
         else:
             indices = self.values
         self.indexed_symbols[e] = ForLoopIndexedSymbol(tree, indices)
 
+    def full_symbol(self, e):
+        # The values of an indexed symbol for all iterations of the loop.  Symbols
+        # indexed by enclosing loops as well take their values from a symbol of
+        # the enclosing loop, holding the values for all iterations of this loop.
+        indexed_symbol = self.indexed_symbols[e]
+        if isinstance(indexed_symbol.tree, ca.MX):
+            return indexed_symbol.tree
+        orig = self.generator.nodes[self.generator.current_class][indexed_symbol.tree.name]
+        src = self.generator.current_value(orig)[indexed_symbol.indices - 1]
+        if e.numel() > 1:
+            src = ca.reshape(src, e.size1(), e.size2() * len(self.values))
+        return src
+
 
 Assignment = namedtuple('Assignment', ['left', 'right'])
 
+# The current values of the variables assigned in a function or for loop
+# body, and the statements directly in that body.
+StatementScope = namedtuple('StatementScope', ['statements', 'values'])
+
 
 # noinspection PyPep8Naming,PyUnresolvedReferences
 class Generator(TreeListener):
-    def __init__(self, root: ast.Collection, class_name: str):
+    def __init__(self, root: ast.Collection, class_name: str, options: Dict[str, str]={}):
         super(Generator, self).__init__()
+        self.options = options
         self.src = {}
         self.model = Model()
         self.root = root
@@ -81,7 +377,14 @@ class Generator(TreeListener):
         self.derivative = {}
         self.for_loops = deque()
         self.functions = {}
+        self.function_keys = {}
         self.entered_classes = deque()
+        self.scopes = deque()
+        self.expressions = {}
+        self.n_expressions = 0
+        self.top_level_equations = set()
+        self.loop_bodies = {}
+        self.mapped_functions = {}
 
     @property
     def current_class(self):
@@ -112,11 +415,22 @@ class Generator(TreeListener):
         self.entered_classes.append(tree)
         self.nodes.setdefault(tree, {})
 
+        if tree.type == 'function':
+            self.scopes.append(StatementScope({id(s) for s in tree.statements}, {}))
+        else:
+            self.top_level_equations.update(id(e) for e in itertools.chain(tree.equations, tree.initial_equations))
+
     def exitClass(self, tree):
         logger.debug('exitClass {}'.format(tree.name))
 
         if tree.type == 'function':
-            # Already handled previously
+            # The function itself is created when it is first called, from
+            # the values of the variables at the end of its body.
+            self.src[tree] = self.scopes.pop().values
+            if self.options.get('release_expressions', False):
+                for statement in tree.statements:
+                    self.release(statement)
+                    self.src.pop(statement, None)
             self.entered_classes.pop()
             return
 
@@ -158,8 +472,18 @@ class Generator(TreeListener):
         def discard_empty(l):
             return list(filter(lambda x: not x.is_empty(), l))
 
-        self.model.equations = discard_empty([self.get_mx(e) for e in tree.equations])
-        self.model.initial_equations = discard_empty([self.get_mx(e) for e in tree.initial_equations])
+        equations = [self.get_mx(e) for e in tree.equations]
+        initial_equations = [self.get_mx(e) for e in tree.initial_equations]
+        if self.options.get('instance_functions', False):
+            equations = self.share_instance_functions(tree.equations, equations)
+            initial_equations = self.share_instance_functions(tree.initial_equations, initial_equations)
+
+        self.model.equations = discard_empty(equations)
+        self.model.initial_equations = discard_empty(initial_equations)
+
+        if self.options.get('cse', False):
+            logger.info('Common subexpression elimination reduced {} expressions to {}'.format(
+                self.n_expressions, len(self.expressions)))
 
         if len(tree.statements) + len(tree.initial_statements) > 0:
             raise NotImplementedError('Statements are currently supported inside functions only')
@@ -186,83 +510,24 @@ class Generator(TreeListener):
         logger.debug('exitExpression')
 
         n_operands = len(tree.operands)
-        if op == 'der':
-            orig = self.get_mx(tree.operands[0])
-            if orig in self.derivative:
-                src = self.derivative[orig]
-            else:
-                s = ca.MX.sym("der({})".format(orig.name()), orig.sparsity())
-                self.derivative[orig] = s
-                self.nodes[self.current_class][s] = s
-                src = s
-        elif op == '-' and n_operands == 1:
-            src = -self.get_mx(tree.operands[0])
-        elif op == 'mtimes':
-            assert n_operands >= 2
-            src = self.get_mx(tree.operands[0])
-            for i in tree.operands[1:]:
-                src = ca.mtimes(src, self.get_mx(i))
-        elif op == 'transpose' and n_operands == 1:
-            src = self.get_mx(tree.operands[0]).T
-        elif op == 'sum' and n_operands == 1:
-            v = self.get_mx(tree.operands[0])
-            src = ca.sum1(v)
-        elif op == 'linspace' and n_operands == 3:
-            a = self.get_mx(tree.operands[0])
-            b = self.get_mx(tree.operands[1])
-            n_steps = self.get_integer(tree.operands[2])
-            src = ca.linspace(a, b, n_steps)
-        elif op == 'fill' and n_operands == 2:
-            val = self.get_mx(tree.operands[0])
-            n_row = self.get_integer(tree.operands[1])
-            src = val * ca.DM.ones(n_row)
-        elif op == 'fill' and n_operands == 3:
-            val = self.get_mx(tree.operands[0])
-            n_row = self.get_integer(tree.operands[1])
-            n_col = self.get_integer(tree.operands[2])
-            src = val * ca.DM.ones(n_row, n_col)
-        elif op == 'zeros' and n_operands == 1:
-            n_row = self.get_integer(tree.operands[0])
-            src = ca.DM.zeros(n_row)
-        elif op == 'zeros' and n_operands == 2:
-            n_row = self.get_integer(tree.operands[0])
-            n_col = self.get_integer(tree.operands[1])
-            src = ca.DM.zeros(n_row, n_col)
-        elif op == 'ones' and n_operands == 1:
-            n_row = self.get_integer(tree.operands[0])
-            src = ca.DM.ones(n_row)
-        elif op == 'ones' and n_operands == 2:
-            n_row = self.get_integer(tree.operands[0])
-            n_col = self.get_integer(tree.operands[1])
-            src = ca.DM.ones(n_row, n_col)
-        elif op == 'identity' and n_operands == 1:
-            n = self.get_integer(tree.operands[0])
-            src = ca.DM.eye(n)
-        elif op == 'diagonal' and n_operands == 1:
-            diag = self.get_mx(tree.operands[0])
-            n = len(diag)
-            indices = list(range(n))
-            src = ca.DM.triplet(indices, indices, diag, n, n)
-        elif op == 'delay' and n_operands == 2:
-            expr = self.get_mx(tree.operands[0])
-            delay_time = self.get_mx(tree.operands[1])
-            if not isinstance(expr, ca.MX) or not expr.is_symbolic():
-                # TODO
-                raise NotImplementedError('Currently, delay() is only supported with a variable as argument.')
-            src = ca.MX.sym('{}_delayed_{}'.format(
-                expr.name(), delay_time), *expr.size())
-            delayed_state = DelayedState(src.name(), expr.name(), delay_time)
-            self.model.delayed_states.append(delayed_state)
-            self.model.inputs.append(Variable(src))
-        elif op in OP_MAP and n_operands == 2:
-            lhs = ca.MX(self.get_mx(tree.operands[0]))
-            rhs = ca.MX(self.get_mx(tree.operands[1]))
-            lhs_op = getattr(lhs, OP_MAP[op])
-            src = lhs_op(rhs)
-        elif op in OP_MAP and n_operands == 1:
-            lhs = ca.MX(self.get_mx(tree.operands[0]))
-            lhs_op = getattr(lhs, OP_MAP[op])
-            src = lhs_op()
+
+        key = None
+        if self.options.get('cse', False) and op != 'delay':
+            # Structurally identical expressions are converted once.  As the
+            # operands are converted in the same way, it suffices to compare
+            # them by identity.  We keep them, so that their ids stay unique.
+            self.n_expressions += 1
+            operands = [self.get_mx(operand) for operand in tree.operands]
+            key = (op, cse_key(operands))
+            if key in self.expressions:
+                self.src[tree] = self.expressions[key][0]
+                return
+
+        handler = OPERATORS.get((op, n_operands), None)
+        if handler is None:
+            handler = OPERATORS.get((op, None), None)
+        if handler is not None:
+            src = handler(self, tree)
         else:
             src = self.get_mx(tree.operands[0])
             # Check for built-in operations, such as the
@@ -281,6 +546,8 @@ class Generator(TreeListener):
                 src = ca.vertcat(*function.call([self.get_mx(operand) for operand in tree.operands]))
 
         self.src[tree] = src
+        if key is not None:
+            self.expressions[key] = (src, operands)
 
     def exitIfExpression(self, tree):
         logger.debug('exitIfExpression')
@@ -319,6 +586,7 @@ class Generator(TreeListener):
                 src_left = src_left[0:src_right.size1()]
 
         self.src[tree] = src_left - src_right
+        self.release_equation(tree)
 
     def enterForEquation(self, tree):
         logger.debug('enterForEquation')
@@ -338,18 +606,16 @@ class Generator(TreeListener):
             arg_names = [arg.name() for arg in args]
             free_vars = [e for e in free_vars if e.name() not in arg_names]
             all_args = args + free_vars
-            F = ca.Function('loop_body_' + f.name, all_args, [expr])
+            F = self.get_loop_body(f, all_args, [expr])
 
-            indexed_symbols_full = [self.nodes[self.current_class][
-                                        f.indexed_symbols[k].tree.name][f.indexed_symbols[k].indices - 1] for k in
-                                    indexed_symbols]
-            Fmap = F.map("map", "serial", len(f.values), list(
-                range(len(args), len(all_args))), [])
+            indexed_symbols_full = [f.full_symbol(k) for k in indexed_symbols]
+            Fmap = self.map_loop_body(f, F, list(range(len(args), len(all_args))))
             res = Fmap.call([f.values] + indexed_symbols_full + free_vars)
 
             self.src[tree] = res[0].T
         else:
             self.src[tree] = ca.MX()
+        self.release_equation(tree)
 
     def exitIfEquation(self, tree):
         logger.debug('exitIfEquation')
@@ -369,6 +635,7 @@ class Generator(TreeListener):
             src = ca.if_else(cond, expr1, src)
 
         self.src[tree] = src
+        self.release_equation(tree)
 
     def exitAssignmentStatement(self, tree):
         logger.debug('exitAssignmentStatement')
@@ -377,9 +644,15 @@ class Generator(TreeListener):
 
         expr = self.get_mx(tree.right)
         for component_ref in tree.left:
-            all_assignments.append(Assignment(self.get_mx(component_ref), expr))
+            # We assign to the variable itself, rather than to its current value
+            if isinstance(component_ref, ast.ComponentRef):
+                left = self.get_component(component_ref, current_value=False)
+            else:
+                left = self.get_mx(component_ref)
+            all_assignments.append(Assignment(left, expr))
 
         self.src[tree] = all_assignments
+        self.assign(tree)
 
     def exitIfStatement(self, tree):
         logger.debug('exitIfStatement')
@@ -412,92 +685,368 @@ class Generator(TreeListener):
                 all_assignments.append(Assignment(assignment.left, src))
 
         self.src[tree] = all_assignments
+        self.assign(tree)
 
     def enterForStatement(self, tree):
         logger.debug('enterForStatement')
 
         self.for_loops.append(ForLoop(self, tree))
+        self.scopes.append(StatementScope({id(s) for s in tree.statements}, {}))
 
     def exitForStatement(self, tree):
         logger.debug('exitForStatement')
 
         f = self.for_loops.pop()
+        scope = self.scopes.pop()
         if len(f.values) > 0:
+            # The loop body maps the values of the variables at the start of
+            # an iteration to their values at the end.
+            variables = list(scope.values.keys())
+            body = [scope.values[v] for v in variables]
             indexed_symbols = list(f.indexed_symbols.keys())
             args = [f.index_variable] + indexed_symbols
-            expr = ca.vcat([ca.vec(self.get_mx(e.right)) for e in tree.statements])
-            free_vars = ca.symvar(expr)
+            free_vars = ca.symvar(ca.vcat([ca.vec(e) for e in body]))
 
             arg_names = [arg.name() for arg in args]
             free_vars = [e for e in free_vars if e.name() not in arg_names]
             all_args = args + free_vars
-            F = ca.Function('loop_body_' + f.name, all_args, [expr])
+            F = self.get_loop_body(f, all_args, body)
+
+            values = {v: self.current_value(v) for v in free_vars}
+            variable_names = {v.name() for v in variables}
+            if any(v.name() in variable_names for v in free_vars):
+                # Values are carried from one iteration to the next, so we
+                # apply the body once per iteration.
+                indexed_symbols_full = [ca.reshape(f.full_symbol(k), 1, -1) for k in indexed_symbols]
+                for i, index in enumerate(f.values):
+                    indexed_values = [full[:, i * k.numel():(i + 1) * k.numel()]
+                                      for k, full in zip(indexed_symbols, indexed_symbols_full)]
+                    res = F.call([index] + indexed_values + [values[v] for v in free_vars])
+                    values.update(zip(variables, res))
+            else:
+                # The iterations are independent, so the body is mapped, and
+                # the variables take their values from the last iteration.
+                indexed_symbols_full = [f.full_symbol(k) for k in indexed_symbols]
+                Fmap = self.map_loop_body(f, F, list(range(len(args), len(all_args))))
+                res = Fmap.call([f.values] + indexed_symbols_full + [values[v] for v in free_vars])
+                n = len(f.values)
+                for v, r in zip(variables, res):
+                    values[v] = r[:, (n - 1) * (r.size2() // n):]
+
+            self.src[tree] = [Assignment(v, values[v]) for v in variables]
+        else:
+            self.src[tree] = []
+        self.assign(tree)
+
+    def assign(self, tree):
+        # Statements directly in a function or for loop body update the
+        # current values of the variables they assign to.
+        if len(self.scopes) > 0 and id(tree) in self.scopes[-1].statements:
+            for assignment in self.src[tree]:
+                self.scopes[-1].values[assignment.left] = assignment.right
+
+    def current_value(self, s):
+        # The current value of a variable in a function or for loop body
+        if len(self.scopes) > 0:
+            return self.scopes[-1].values.get(s, s)
+        return s
 
-            indexed_symbols_full = [self.nodes[self.current_class][
-                                        f.indexed_symbols[k].tree.name][f.indexed_symbols[k].indices - 1] for k in
-                                    indexed_symbols]
-            Fmap = F.map("map", "serial", len(f.values), list(
-                range(len(args), len(all_args))), [])
-            res = Fmap.call([f.values] + indexed_symbols_full + free_vars)
+    def release_equation(self, tree):
+        # Once an equation of the class itself has been converted, only its
+        # conversion is needed.
+        if self.options.get('release_expressions', False) and id(tree) in self.top_level_equations:
+            self.release(tree)
 
-            # Split into a list of statements
-            variables = [assignment.left for statement in tree.statements for assignment in self.get_mx(statement)]
-            all_assignments = []
-            for i in range(len(f.values)):
-                for j, variable in enumerate(variables):
-                    all_assignments.append(Assignment(variable, res[0][j, i].T))
+    def release(self, tree):
+        """
+        Release the conversions of the nodes below a converted node, other
+        than those of symbols.
+        :param tree: converted node
+        :return: None
+        """
+        stack = list(tree.__dict__.values())
+        while stack:
+            node = stack.pop()
+            if isinstance(node, ast.Symbol):
+                continue
+            elif isinstance(node, ast.Node):
+                self.src.pop(node, None)
+                stack.extend(node.__dict__.values())
+            elif isinstance(node, dict):
+                stack.extend(node.values())
+            elif isinstance(node, list):
+                stack.extend(node)
+
+    def get_loop_body(self, for_loop: ForLoop, args: list, body: list) -> ca.Function:
+        """
+        Create the function evaluating the body of a for loop.  Loops with
+        structurally identical bodies, such as the loops of the instances of
+        a component class, share a single function.
+        :param for_loop: for loop
+        :param args: loop index, indexed symbols and free variables
+        :param body: values of the loop body
+        :return: function
+        """
+        key = (self.loop_body_key(for_loop.tree),
+               tuple(arg.size() for arg in args), tuple(ca.MX(b).size() for b in body))
+        if key not in self.loop_bodies:
+            self.loop_bodies[key] = ca.Function('loop_body_' + for_loop.name, args, body)
+        return self.loop_bodies[key]
 
-            self.src[tree] = all_assignments
-        else:
-            self.src[tree] = []
+    def loop_body_key(self, tree: Union[ast.ForEquation, ast.ForStatement]) -> tuple:
+        """
+        The conversion of a loop body only depends on the values of the
+        symbols it references through the indices and dimensions that are
+        evaluated while converting it.  The names of the symbols are replaced
+        by their order of appearance, so that the loops of different
+        instances have the same key.
+        :param tree: for loop
+        :return: key identifying the structure of the body of the loop
+        """
+        loop_names = {'time'} | {f.name for f in self.for_loops} | {
+            index.name for index in tree.indices}
+        stack = [v for k, v in tree.__dict__.items() if k != 'indices']
+        while stack:
+            node = stack.pop()
+            if isinstance(node, ast.ForIndex):
+                loop_names.add(node.name)
+            if isinstance(node, ast.Node):
+                stack.extend(node.__dict__.values())
+            elif isinstance(node, (dict, list)):
+                stack.extend(node.values() if isinstance(node, dict) else node)
+
+        evaluator = constant_evaluator(self.current_class)
+        names = {}
+
+        def signature(node):
+            if isinstance(node, ast.ComponentRef):
+                if node.name in loop_names:
+                    name = node.name
+                elif node.name in names:
+                    name = names[node.name]
+                else:
+                    name = names[node.name] = len(names)
+                    try:
+                        value = evaluator.evaluate(ast.ComponentRef(name=node.name))
+                    except ConstantEvaluationError:
+                        value = None
+                    if isinstance(value, np.ndarray):
+                        name = (name, value.shape, tuple(value.ravel().tolist()))
+                    elif not isinstance(value, ca.MX):
+                        name = (name, value)
+                src = self.src.get(node, None)
+                return ('ComponentRef', name, signature(node.indices), signature(node.child),
+                        src.size() if isinstance(src, ca.MX) else None)
+            elif isinstance(node, ast.Node):
+                # The range of the loop itself only matters for mapping its body
+                skip = {'comment', 'indices'} if node is tree else {'comment'}
+                return (type(node).__name__,) + tuple((k, signature(v)) for k, v in sorted(
+                    node.__dict__.items()) if not k.startswith('_') and k not in skip)
+            elif isinstance(node, list):
+                return tuple(signature(v) for v in node)
+            elif isinstance(node, dict):
+                return tuple((k, signature(v)) for k, v in sorted(node.items()))
+            return node
+
+        return tuple(index.name for index in tree.indices), signature(tree)
+
+    def map_loop_body(self, for_loop: ForLoop, F: ca.Function, reduce_in: list = []) -> ca.Function:
+        """
+        Map a function over the iterations of a for loop.  The map mode is
+        taken from the 'map_modes' option for the loop index, if present, and
+        from the 'map_mode' option otherwise.  Loops with fewer iterations
+        than the 'map_threshold' option are mapped serially.  The 'map_threads'
+        option limits the number of threads of the 'thread' mode.
+        :param for_loop: for loop
+        :param F: function to map
+        :param reduce_in: inputs that are the same for every iteration
+        :return: mapped function
+        """
+        n = len(for_loop.values)
+        mode = self.options.get('map_modes', {}).get(for_loop.name, self.options.get('map_mode', 'serial'))
+        if n < self.options.get('map_threshold', 0):
+            mode = 'serial'
+
+        return self.map_function(F, n, mode, reduce_in)
+
+    def map_function(self, F: ca.Function, n: int, mode: str, reduce_in: list = []) -> ca.Function:
+        """
+        :param F: function to map
+        :param n: number of evaluations
+        :param mode: map mode
+        :param reduce_in: inputs that are the same for every evaluation
+        :return: mapped function
+        """
+        # Functions shared by several loops are mapped once
+        key = (id(F), n, mode, tuple(reduce_in))
+        if key in self.mapped_functions and self.mapped_functions[key][0] is F:
+            return self.mapped_functions[key][1]
+
+        opts = {}
+        if mode == 'thread' and self.options.get('map_threads', None) is not None:
+            opts['max_num_threads'] = int(self.options['map_threads'])
+
+        F_map = F.map("map", mode, n, reduce_in, [], opts)
+        self.mapped_functions[key] = (F, F_map)
+        return F_map
+
+    def share_instance_functions(self, equations: list, srcs: list) -> list:
+        """
+        Convert the equations of component instances with the same equations
+        up to the instance name to a single function, mapped over the
+        instances.  The equations of an instance are those that only
+        reference components of that instance, other than time.  For
+        equations are always converted as they are.
+        :param equations: equations of the class
+        :param srcs: converted equations
+        :return: converted equations, with the equations of repeated instances taken from the mapped function
+        """
+        # Group the equations by instance, and the instances by their
+        # equations with the instance name left out.
+        instances = OrderedDict()
+        for i, e in enumerate(equations):
+            if isinstance(e, ast.ForEquation):
+                continue
+            prefix = instance_prefix(component_names(e))
+            if prefix:
+                instances.setdefault(prefix, []).append(i)
+
+        groups = OrderedDict()
+        for prefix, indices in instances.items():
+            signature = instance_signature([equations[i] for i in indices], prefix)
+            if any(has_operator(equations[i], 'delay') for i in indices):
+                continue
+            groups.setdefault(signature, []).append((prefix, indices))
+
+        srcs = list(srcs)
+        n_functions = 0
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+
+            # The function is created from the converted equations of the first instance
+            prefix, indices = group[0]
+            outputs = [ca.MX(srcs[i]) for i in indices]
+            inputs = ca.symvar(ca.veccat(*outputs))
+            shared = [k for k, s in enumerate(inputs) if not self.instance_name(s.name(), prefix)]
+
+            # Look up the counterparts of the inputs for the other instances
+            args = []
+            members = []
+            for other_prefix, instance_indices in group:
+                instance_args = [self.instance_symbol(s, prefix, other_prefix) for s in inputs]
+                if any(a is None or a.sparsity() != s.sparsity() for a, s in zip(instance_args, inputs)):
+                    continue
+                if any(ca.MX(srcs[i]).sparsity() != o.sparsity() for i, o in zip(instance_indices, outputs)):
+                    continue
+                args.append(instance_args)
+                members.append(instance_indices)
+            if len(members) < 2:
+                continue
+
+            F = ca.Function(re.sub(r'\W', '_', 'instance_' + prefix.rstrip('.')), inputs, outputs)
+            F_map = self.map_function(F, len(members), self.options.get('map_mode', 'serial'), shared)
+            results = F_map.call([args[0][k] if k in shared else ca.horzcat(*[a[k] for a in args])
+                                  for k in range(len(inputs))])
+            for m, instance_indices in enumerate(members):
+                for i, o, r in zip(instance_indices, outputs, results):
+                    srcs[i] = r[:, m * o.size2():(m + 1) * o.size2()]
+            n_functions += 1
+
+        logger.info('Converted the equations of repeated instances to {} functions'.format(n_functions))
+        return srcs
+
+    @staticmethod
+    def instance_name(name: str, prefix: str) -> Union[str, None]:
+        """
+        :param name: name of a symbol, or of the derivative of a symbol
+        :param prefix: instance name, followed by a dot
+        :return: name of the symbol relative to the instance, or None if it is not part of the instance
+        """
+        if name.startswith('der(') and name.endswith(')'):
+            name = name[4:-1]
+        if name.startswith(prefix):
+            return name[len(prefix):]
+        return None
+
+    def instance_symbol(self, s: ca.MX, prefix: str, other_prefix: str) -> Union[ca.MX, None]:
+        """
+        :param s: symbol of an instance, or the derivative of such a symbol
+        :param prefix: name of the instance, followed by a dot
+        :param other_prefix: name of another instance, followed by a dot
+        :return: the corresponding symbol of the other instance, or None if there is none
+        """
+        name = self.instance_name(s.name(), prefix)
+        if name is None:
+            return s
+        symbol = self.current_class.symbols.get(other_prefix + name, None)
+        if symbol is None:
+            return None
+        other = self.get_mx(symbol)
+        if s.name().startswith('der('):
+            return self.derivative.get(other, None)
+        return other
+
+    def get_indexed_derivative(self, s):
+        # The derivative of a symbol indexed by a for loop is the derivative of
+        # the full symbol, indexed by the same loop.
+        for_loop = next(f for f in reversed(self.for_loops) if s in f.indexed_symbols)
+        indexed_symbol = for_loop.indexed_symbols[s]
+        if isinstance(indexed_symbol.tree, ca.MX):
+            # Symbol of an enclosing loop
+            outer = indexed_symbol.tree
+            der_outer = self.derivative[outer] if outer in self.derivative else self.get_indexed_derivative(outer)
+            src = ca.MX.sym("der({})".format(s.name()), s.sparsity())
+            for_loop.indexed_symbols[src] = ForLoopIndexedSymbol(der_outer, indexed_symbol.indices)
+            self.derivative[s] = src
+            return src
+
+        orig = self.nodes[self.current_class][indexed_symbol.tree.name]
+        if orig not in self.derivative:
+            der_orig = ca.MX.sym("der({})".format(orig.name()), orig.sparsity())
+            self.derivative[orig] = der_orig
+            self.nodes[self.current_class][der_orig] = der_orig
+
+        der_tree = ast.ComponentRef(name="der({})".format(indexed_symbol.tree.name))
+        self.nodes[self.current_class][der_tree.name] = self.derivative[orig]
+
+        src = ca.MX.sym("der({})".format(s.name()), s.sparsity())
+        for_loop.indexed_symbols[src] = ForLoopIndexedSymbol(der_tree, indexed_symbol.indices)
+        self.derivative[s] = src
+        return src
 
     def get_integer(self, tree: Union[ast.Primary, ast.ComponentRef, ast.Expression, ast.Slice]):
         # CasADi needs to know the dimensions of symbols at instantiation.
         # We therefore need a mechanism to evaluate expressions that define dimensions of symbols.
-        if isinstance(tree, ast.Primary):
-            return int(tree.value)
-        if isinstance(tree, ast.ComponentRef):
-            s = self.current_class.symbols[tree.name]
-            assert (s.type.name == 'Integer')
-            return self.get_integer(s.value)
-        if isinstance(tree, ast.Expression):
-            # Make sure that the expression has been converted to MX by (re)visiting the
-            # relevant part of the AST.
-            ast_walker = TreeWalker()
-            ast_walker.walk(self, tree)
-
-            # Obtain expression
-            expr = self.get_mx(tree)
-
-            # Obtain the symbols it depends on
-            deps = [expr.dep(i) for i in range(expr.n_dep())
-                    if expr.dep(i).is_symbolic()]
-
-            # Find the values of the symbols
-            vals = []
-            for dep in deps:
-                if dep.is_symbolic():
-                    if (len(self.for_loops) > 0) and (dep.name() == self.for_loops[-1].name):
-                        vals.append(self.for_loops[-1].index_variable)
-                    else:
-                        vals.append(self.get_integer(self.current_class.symbols[dep.name()].value))
-
-            # Evaluate the expression
-            F = ca.Function('get_integer_{}'.format('_'.join([dep.name().replace('.', '_') for dep in deps])), deps,
-                            [expr])
-            ret = F.call(vals)
-            if ret[0].is_constant():
-                return int(ret[0])
-            else:
-                logger.warning('Failed to determine integer value of expression {}'.format(expr))
-                return ret[0]
-        if isinstance(tree, ast.Slice):
-            start = self.get_integer(tree.start)
-            step = self.get_integer(tree.step)
-            stop = self.get_integer(tree.stop)
-            return np.arange(start, stop + step, step, dtype=np.int)
+        # Expressions in the indices of for loops evaluate to expressions in the loop index.
+        variables = {f.name: f.index_variable for f in self.for_loops}
+        try:
+            value = constant_evaluator(self.current_class).evaluate(tree, variables)
+        except ConstantEvaluationError as e:
+            raise Exception('Failed to determine integer value of {}: {}'.format(tree, e))
+        if isinstance(value, ca.MX):
+            return int(ca.DM(value)) if value.is_constant() else value
+        elif isinstance(value, np.ndarray):
+            return value
         else:
-            raise Exception('Unexpected node type {}'.format(tree.__class__.__name__))
+            return int(value)
+
+    def get_loop_indices(self, indices: list, for_loops: list) -> np.ndarray:
+        """
+        Evaluate indices with NumPy, for all iterations of for loops at once.
+        :param indices: index expressions
+        :param for_loops: loops, from the outermost to the innermost, in the order in which they iterate
+        :return: array with a row of values for every index
+        """
+        grid = [g.ravel() for g in np.meshgrid(*[f.values for f in for_loops], indexing='ij')]
+        variables = {f.name: f.index_variable for f in self.for_loops}
+        variables.update({f.name: g for f, g in zip(for_loops, grid)})
+        evaluator = constant_evaluator(self.current_class)
+        try:
+            values = [np.broadcast_to(evaluator.evaluate(index, variables), grid[0].shape) for index in indices]
+        except ConstantEvaluationError as e:
+            raise Exception('Failed to determine integer values of {}: {}'.format(indices, e))
+        return np.array(values, dtype=np.int)
 
     def get_python_type(self, tree):
         if tree.type.name == 'Boolean':
@@ -519,34 +1068,80 @@ class Generator(TreeListener):
         return s
 
     def get_indexed_symbol(self, tree, s):
+        indices = [self.get_integer(index) for index in tree.indices]
+
         # Check whether we loop over an index of this symbol
-        indices = []
-        for index in tree.indices:
-            if isinstance(index, ast.ComponentRef):
-                for for_loop in self.for_loops:
-                    if index.name == for_loop.name:
-                        # TODO support nested loops
-                        s = ca.MX.sym('{}[{}]'.format(tree.name, for_loop.name))
-                        for_loop.register_indexed_symbol(s, tree)
-                        return s
-
-            sl = self.get_integer(index)
-            if not isinstance(sl, int) and not isinstance(sl, np.ndarray):
-                for_loop = self.for_loops[-1]
+        loop_indices = [i for i in indices if isinstance(i, ca.MX)]
+        if loop_indices:
+            for_loops = [f for f in self.for_loops if any(ca.depends_on(i, f.index_variable) for i in loop_indices)]
+            if len(indices) == 1 and len(for_loops) == 1:
+                for_loop = for_loops[0]
                 s = ca.MX.sym('{}[{}]'.format(tree.name, for_loop.name))
-                for_loop.register_indexed_symbol(s, tree, sl)
+                if isinstance(tree.indices[0], ast.ComponentRef) and tree.indices[0].name == for_loop.name:
+                    for_loop.register_indexed_symbol(s, tree)
+                else:
+                    for_loop.register_indexed_symbol(s, tree, tree.indices[0])
                 return s
+            return self.get_nested_indexed_symbol(tree, s, indices, for_loops)
+
+        # Modelica indexing starts from one;  Python from zero.
+        indices = [i - 1 for i in indices]
+        if len(indices) > 2:
+            raise Exception("Dimensions higher than two are not yet supported")
+
+        key = None
+        if self.options.get('cse', False):
+            # Elements referenced more than once are extracted once
+            self.n_expressions += 1
+            key = ('[]', id(s), tuple((np.shape(i), tuple(np.ravel(i).tolist())) for i in indices))
+            if key in self.expressions:
+                return self.expressions[key][0]
 
-            # Modelica indexing starts from one;  Python from zero.
-            indices.append(sl - 1)
         if len(indices) == 1:
-            return s[indices[0]]
-        elif len(indices) == 2:
-            return s[indices[0], indices[1]]
+            src = s[indices[0]]
         else:
+            src = s[indices[0], indices[1]]
+
+        if key is not None:
+            self.expressions[key] = (src, s)
+        return src
+
+    def get_nested_indexed_symbol(self, tree, s, indices, for_loops):
+        # A symbol indexed by several, possibly nested, for loops.  We gather the
+        # elements for the Cartesian product of the loop values at once, in the
+        # order in which the loops iterate.  Every loop then maps over a symbol
+        # holding the elements for all iterations of the loops that it encloses.
+        if any(isinstance(i, np.ndarray) for i in indices):
+            raise NotImplementedError('Slices of symbols indexed by for loops are not supported')
+        if len(indices) > 2:
             raise Exception("Dimensions higher than two are not yet supported")
 
-    def get_component(self, tree):
+        name = tree.name
+        loop_names = [f.name for f in for_loops]
+
+        n = int(np.prod([len(f.values) for f in for_loops]))
+        if n == 0:
+            # One of the loops has no iterations, so its body is discarded
+            return ca.MX.sym('{}[{}]'.format(name, ','.join(loop_names)))
+
+        element_indices = self.get_loop_indices(tree.indices, for_loops)
+
+        # Linear indices of the elements, in column-major order
+        linear_indices = element_indices[0]
+        if len(indices) == 2:
+            linear_indices = linear_indices + (element_indices[1] - 1) * s.size1()
+
+        outer = tree
+        outer_indices = linear_indices
+        for k, for_loop in enumerate(for_loops):
+            size = int(np.prod([len(f.values) for f in for_loops[k + 1:]]))
+            e = ca.MX.sym('{}[{}]'.format(name, ','.join(loop_names[:k + 1] + [':'] * (len(for_loops) - k - 1))), 1, size)
+            for_loop.indexed_symbols[e] = ForLoopIndexedSymbol(outer, outer_indices)
+            outer = e
+            outer_indices = for_loop.values
+        return outer
+
+    def get_component(self, tree, current_value=True):
         # Check special symbols
         if tree.name == 'time':
             return self.model.time
@@ -558,6 +1153,8 @@ class Generator(TreeListener):
         # Check ordinary symbols
         symbol = self.current_class.symbols[tree.name]
         s = self.get_mx(symbol)
+        if current_value:
+            s = self.current_value(s)
         if len(tree.indices) > 0:
             s = self.get_indexed_symbol(tree, s)
         return s
@@ -589,46 +1186,225 @@ class Generator(TreeListener):
         except KeyError:
             raise Exception('Unknown function {}'.format(function_name))
 
-        inputs = []
-        outputs = []
-        tmp = []
-        for s in tree.symbols.values():
-            src = self.get_mx(s)
-            if 'input' in s.prefixes:
-                inputs.append(src)
-            elif 'output' in s.prefixes:
-                outputs.append(src)
-            else:
-                tmp.append(src)
+        if not self.load_function(function_name):
+            inputs = []
+            outputs = []
+            for s in tree.symbols.values():
+                src = self.get_mx(s)
+                if 'input' in s.prefixes:
+                    inputs.append(src)
+                elif 'output' in s.prefixes:
+                    outputs.append(src)
+
+            # The statements were converted in order, with every right hand side
+            # expressed in the values of the variables at that point.
+            values = self.src[tree]
+            function = ca.Function(tree.name, inputs, [values[output] for output in outputs])
+            FUNCTION_CACHE[self.function_key(function_name)] = function
+            if len(FUNCTION_CACHE) > FUNCTION_CACHE_SIZE:
+                FUNCTION_CACHE.popitem(last=False)
+            self.functions[function_name] = function
+
+        return self.functions[function_name]
+
+    def load_function(self, function_name: str) -> bool:
+        """
+        Take a function from those converted by earlier generators, so that
+        its body need not be converted again.
+        :param function_name: fully scoped name of the function
+        :return: True if the function was converted before
+        """
+        key = self.function_key(function_name)
+        if key not in FUNCTION_CACHE:
+            return False
+        FUNCTION_CACHE.move_to_end(key)
+        self.functions[function_name] = FUNCTION_CACHE[key]
+        return True
+
+    def function_key(self, function_name: str) -> Tuple[str, str]:
+        """
+        :param function_name: fully scoped name of the function
+        :return: the name of the function, and a hash of its definition and of the definitions of the functions it calls
+        """
+        key = self.function_keys.get(function_name, None)
+        if key is not None:
+            return key
 
-        # Store current variable values
-        values = {}
-        for variable in inputs:
-            values[variable] = variable
+        # Recursive calls only add the name of the function
+        self.function_keys[function_name] = (function_name, '')
 
-        # Process statements in order
-        for statement in tree.statements:
-            src = self.get_mx(statement)
-            for assignment in src:
-                [values[assignment.left]] = ca.substitute([assignment.right], list(values.keys()), list(values.values()))
+        tree = self.root.classes[function_name]
+        definition = json.dumps(ast.Node.to_json(tree), sort_keys=True, separators=(',', ':'))
+        h = hashlib.sha1(definition.encode('utf-8'))
 
-        output_expr = ca.substitute([values[output] for output in outputs], tmp, [values[t] for t in tmp])
-        function = ca.Function(tree.name, inputs, output_expr)
-        self.functions[tree.name] = function
+        # Options such as the map mode change the conversion
+        h.update(repr(sorted(self.options.items())).encode('utf-8'))
+        for name in called_functions(tree, self.root.classes):
+            h.update(CALL_SEPARATOR.join(self.function_key(name)).encode('utf-8'))
 
-        return function
+        key = self.function_keys[function_name] = (function_name, h.hexdigest())
+        return key
 
 
-def generate(ast_tree: ast.Collection, model_name: str) -> Model:
+def called_functions(tree: ast.Class, classes: Dict[str, ast.Class]) -> list:
+    """
+    :param tree: function
+    :param classes: classes of the flattened model, by name
+    :return: sorted names of the functions called by the function
+    """
+    names = set()
+    stack = [tree.__dict__]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Expression) and isinstance(node.operator, str) and \
+                node.operator in classes and classes[node.operator].type == 'function':
+            names.add(node.operator)
+        if isinstance(node, ast.Node):
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return sorted(names)
+
+
+def generate(ast_tree: ast.Collection, model_name: str, options: Dict[str, str]={}) -> Model:
     """
     :param ast_tree: AST to generate from
     :param model_name: class to generate
+    :param options: dictionary of generator options
     :return: casadi model
     """
     component_ref = ast.ComponentRef.from_string(model_name)
     ast_walker = TreeWalker()
-    flat_tree = flatten(ast_tree, component_ref)
+    ast_tree = prune_collection(ast_tree, component_ref)
+    if options.get('streaming', False):
+        return generate_streaming(ast_tree, component_ref, options)
+    flat_tree = flatten(ast_tree, component_ref, cache_folder=options.get('flat_cache_folder', None),
+                        vectorize_arrays=options.get('vectorize_arrays', False),
+                        prune_dead_elements=options.get('prune_dead_elements', False))
     component_ref_tuple = component_ref.to_tuple()
-    casadi_gen = Generator(flat_tree, component_ref_tuple[-1])
-    ast_walker.walk(casadi_gen, flat_tree)
+    casadi_gen = Generator(flat_tree, component_ref_tuple[-1], options)
+    for name, c in flat_tree.classes.items():
+        # Functions converted by earlier generators are not converted again
+        if c.type == 'function' and casadi_gen.load_function(name):
+            continue
+        ast_walker.walk(casadi_gen, c)
+    return casadi_gen.model
+
+
+def generate_streaming(ast_tree: ast.Collection, component_ref: ast.ComponentRef,
+                       options: Dict[str, str]={}) -> Model:
+    """
+    Generate a model while it is being flattened.  Every equation is
+    converted as soon as it is flattened and the symbols it references are
+    final, and its tree is released right after, so the flattened equations
+    of the whole model never have to be held at once.  Equations referencing
+    symbols that depend on components that have not been flattened yet are
+    converted once flattening has finished.
+    :param ast_tree: AST to generate from
+    :param component_ref: class to generate
+    :param options: dictionary of generator options
+    :return: casadi model
+    """
+    if options.get('instance_functions', False):
+        raise ValueError("The 'instance_functions' option compares the equations of the whole flattened model, "
+                         "and cannot be combined with 'streaming'")
+    if options.get('flat_cache_folder', None) is not None or options.get('prune_dead_elements', False):
+        logger.warning('The flat cache and dead element pruning need the whole flattened model, '
+                       'and are not used when streaming')
+
+    ast_walker = TreeWalker()
+    elements = iter_flatten(ast_tree, component_ref, vectorize_arrays=options.get('vectorize_arrays', False))
+
+    # The flat class is filled in as flattening proceeds
+    flat_tree = ast.File()
+    flat_class = next(elements).node
+    flat_tree.classes[flat_class.name] = flat_class
+    casadi_gen = Generator(flat_tree, flat_class.name, options)
+    casadi_gen.enterClass(flat_class)
+
+    def convert(equation):
+        ast_walker.walk(casadi_gen, equation)
+        src = casadi_gen.get_mx(equation)
+        casadi_gen.release(equation)
+        del casadi_gen.src[equation]
+        return src
+
+    equations = {'equation': [], 'initial_equation': []}
+    deferred = []
+    resolved = set()
+    for element in elements:
+        if element.kind == 'function':
+            flat_tree.classes[element.name] = element.node
+            if not casadi_gen.load_function(element.name):
+                ast_walker.walk(casadi_gen, element.node)
+        elif element.kind in equations:
+            if is_resolved(flat_class, element.node, resolved):
+                equations[element.kind].append(convert(element.node))
+            else:
+                deferred.append((element.kind, len(equations[element.kind]), element.node))
+                equations[element.kind].append(None)
+
+    # The references in the symbols are only final once flattening has finished
+    for kind, i, equation in deferred:
+        equations[kind][i] = convert(equation)
+    for sym in flat_class.symbols.values():
+        ast_walker.walk(casadi_gen, sym)
+    casadi_gen.exitClass(flat_class)
+
+    casadi_gen.model.equations = [e for e in equations['equation'] if not e.is_empty()]
+    casadi_gen.model.initial_equations = [e for e in equations['initial_equation'] if not e.is_empty()]
     return casadi_gen.model
+
+
+def is_resolved(flat_class: ast.Class, tree: ast.Node, resolved: set) -> bool:
+    """
+    Check whether the references in a tree, and in the dimensions and values
+    of the symbols it references, have been resolved to symbols of a flat
+    class that is still being flattened.
+    :param flat_class: flat class
+    :param tree: tree
+    :param resolved: names of the symbols known to be resolved, which is added to
+    :return: True if all references have been resolved
+    """
+    loop_indices = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.ForIndex):
+            loop_indices.add(node.name)
+        if isinstance(node, ast.Node):
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, (dict, list)):
+            stack.extend(node.values() if isinstance(node, dict) else node)
+
+    symbols = set()
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Symbol):
+            if node.name not in resolved and node.name not in symbols:
+                symbols.add(node.name)
+                stack.extend(node.dimensions)
+                stack.append(node.value)
+        elif isinstance(node, ast.ComponentRef):
+            if node.child:
+                return False
+            stack.extend(node.indices)
+            if node.name != 'time' and node.name not in loop_indices:
+                sym = flat_class.symbols.get(node.name, None)
+                if sym is None:
+                    return False
+                stack.append(sym)
+        elif isinstance(node, ast.Expression):
+            stack.extend(node.operands)
+        elif isinstance(node, ast.Node):
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+
+    resolved.update(symbols)
+    return True
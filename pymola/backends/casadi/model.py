@@ -65,6 +65,8 @@ class Model:
         self.initial_equations = []
         self.time = ca.MX.sym('time')
         self.delayed_states = []
+        self.expand_sx = False
+        self._sx_outputs = {}
 
     def __str__(self):
         r = ""
@@ -83,7 +85,8 @@ class Model:
 
     def check_balanced(self):
         n_states = sum(v.symbol.size1() * v.symbol.size2() for v in itertools.chain(self.states, self.alg_states))
-        n_equations = sum(e.size1() * e.size2() for e in self.dae_residual_function.mx_out())
+        dae_residual_function = self.dae_residual_function
+        n_equations = sum(dae_residual_function.numel_out(i) for i in range(dae_residual_function.n_out()))
         if n_states == n_equations:
             logger.info("System is balanced.")
         else:
@@ -95,6 +98,68 @@ class Model:
     def _symbols(self, l):
         return [v.symbol for v in l]
 
+    def _function(self, name, inputs, outputs, concatenate=False):
+        """
+        Create a function of MX expressions.  If the model is to be expanded
+        into SX, the outputs are evaluated by an SX function instead.  Outputs
+        that cannot be expressed in SX, such as calls to lookup tables, are
+        kept in MX, and the SX function is then called from an MX function.
+        :param name: name of the function
+        :param inputs: input symbols
+        :param outputs: output expressions
+        :param concatenate: concatenate the outputs into a single output
+        :return: function
+        """
+        def function(name, outputs):
+            if concatenate:
+                outputs = [ca.veccat(*outputs)] if len(outputs) > 0 else []
+            return ca.Function(name, inputs, outputs)
+
+        if not self.expand_sx or len(outputs) == 0:
+            # SX functions need at least one output
+            return function(name, outputs)
+
+        # The outputs that can be expanded are determined once, when the
+        # model is simplified.
+        if self._sx_outputs.get(name, (None,))[0] != len(outputs):
+            self._sx_outputs[name] = (len(outputs), self._expandable_outputs(name, inputs, outputs))
+        sx_outputs = self._sx_outputs[name][1]
+
+        if len(sx_outputs) == len(outputs):
+            return function(name, outputs).expand()
+
+        outputs = list(outputs)
+        if len(sx_outputs) > 0:
+            f_sx = ca.Function(name + '_sx', inputs, [outputs[i] for i in sx_outputs]).expand()
+            for i, output in zip(sx_outputs, f_sx.call(inputs)):
+                outputs[i] = output
+        return function(name, outputs)
+
+    def _expandable_outputs(self, name, inputs, outputs):
+        """
+        Determine which outputs of a function can be expressed in SX.
+        :param name: name of the function
+        :param inputs: input symbols
+        :param outputs: output expressions
+        :return: indices of the outputs that can be expanded
+        """
+        try:
+            ca.Function(name, inputs, outputs).expand()
+            return list(range(len(outputs)))
+        except RuntimeError:
+            pass
+
+        sx_outputs = []
+        for i, output in enumerate(outputs):
+            try:
+                ca.Function(name, inputs, [output]).expand()
+                sx_outputs.append(i)
+            except RuntimeError:
+                logger.debug('Output {} of {} cannot be expanded into SX'.format(i, name))
+
+        logger.info('{} of {} outputs of {} are expanded into SX'.format(len(sx_outputs), len(outputs), name))
+        return sx_outputs
+
     def simplify(self, options):
         if options.get('replace_parameter_expressions', False):
             logger.info("Replacing parameter expressions")
@@ -506,18 +571,28 @@ class Model:
             if len(self.initial_equations) > 0:
                 self.initial_equations = ca.matrix_expand(self.initial_equations)
 
+        if options.get('expand_sx', False):
+            logger.info("Expanding functions into SX")
+
+            # Decide which outputs can be expanded, now that the equations
+            # are final.  The functions themselves are created on demand.
+            self.expand_sx = True
+            self._sx_outputs = {}
+            for f_name in ['dae_residual', 'initial_residual', 'variable_metadata']:
+                getattr(self, f_name + '_function')
+
     @property
     def dae_residual_function(self):
-        return ca.Function('dae_residual', [self.time, ca.veccat(*self._symbols(self.states)), ca.veccat(*self._symbols(self.der_states)),
-                                            ca.veccat(*self._symbols(self.alg_states)), ca.veccat(*self._symbols(self.inputs)), ca.veccat(*self._symbols(self.constants)),
-                                            ca.veccat(*self._symbols(self.parameters))], [ca.veccat(*self.equations)] if len(self.equations) > 0 else [])
+        return self._function('dae_residual', [self.time, ca.veccat(*self._symbols(self.states)), ca.veccat(*self._symbols(self.der_states)),
+                                               ca.veccat(*self._symbols(self.alg_states)), ca.veccat(*self._symbols(self.inputs)), ca.veccat(*self._symbols(self.constants)),
+                                               ca.veccat(*self._symbols(self.parameters))], self.equations, concatenate=True)
 
     # noinspection PyUnusedLocal
     @property
     def initial_residual_function(self):
-        return ca.Function('initial_residual', [self.time, ca.veccat(*self._symbols(self.states)), ca.veccat(*self._symbols(self.der_states)),
-                                            ca.veccat(*self._symbols(self.alg_states)), ca.veccat(*self._symbols(self.inputs)), ca.veccat(*self._symbols(self.constants)),
-                                            ca.veccat(*self._symbols(self.parameters))], [ca.veccat(*self.initial_equations)] if len(self.initial_equations) > 0 else [])
+        return self._function('initial_residual', [self.time, ca.veccat(*self._symbols(self.states)), ca.veccat(*self._symbols(self.der_states)),
+                                                   ca.veccat(*self._symbols(self.alg_states)), ca.veccat(*self._symbols(self.inputs)), ca.veccat(*self._symbols(self.constants)),
+                                                   ca.veccat(*self._symbols(self.parameters))], self.initial_equations, concatenate=True)
 
     # noinspection PyPep8Naming
     @property
@@ -531,4 +606,4 @@ class Model:
                     value = value if value.numel() != 1 else ca.repmat(value, *variable.symbol.size())
                     attribute_lists[attribute_list_index].append(value)
             out.append(ca.horzcat(*[ca.veccat(*attribute_list) for attribute_list in attribute_lists]))
-        return ca.Function('variable_metadata', [ca.veccat(*self._symbols(self.parameters))], out) 
+        return self._function('variable_metadata', [ca.veccat(*self._symbols(self.parameters))], out)
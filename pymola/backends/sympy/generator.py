@@ -7,7 +7,7 @@ from typing import List
 import jinja2
 
 from pymola import ast
-from pymola.tree import TreeListener, TreeWalker, flatten
+from pymola.tree import TreeListener, TreeWalker, flatten, prune_collection
 
 FILE_DIR = os.path.dirname(os.path.realpath(__file__))
 # noinspection PyUnresolvedReferences
@@ -165,6 +165,8 @@ class {{tree.name}}(OdeModel):
                 op=op,
                 left=self.src[tree.operands[0]],
                 right=self.src[tree.operands[1]])
+        elif op == '+' and n_operands > 2:
+            src = ' + '.join([self.src[o] for o in tree.operands])
         elif op in ['+', '-'] and n_operands == 1:
             src = '{op:s} {expr:s}'.format(
                 op=op,
@@ -200,16 +202,17 @@ class {{tree.name}}(OdeModel):
             right=self.src[tree.right])
 
 
-def generate(ast_tree: ast.Collection, model_name: str):
+def generate(ast_tree: ast.Collection, model_name: str, flat_cache_folder: str = None):
     """
     :param ast_tree: AST to generate from
     :param model_name: class to generate
+    :param flat_cache_folder: folder in which to cache the flattened model
     :return: sympy source code for model
     """
     component_ref = ast.ComponentRef.from_string(model_name)
-    ast_tree_new = copy.deepcopy(ast_tree)
+    ast_tree_new = copy.deepcopy(prune_collection(ast_tree, component_ref))
     ast_walker = TreeWalker()
-    flat_tree = flatten(ast_tree_new, component_ref)
+    flat_tree = flatten(ast_tree_new, component_ref, cache_folder=flat_cache_folder)
     sympy_gen = SympyGenerator()
     ast_walker.walk(sympy_gen, flat_tree)
     return sympy_gen.src[flat_tree]
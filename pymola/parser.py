@@ -483,8 +483,21 @@ class ASTListener(ModelicaListener):
         # type, and all its symbols' types, pointing at the same empty
         # (ComponentRef) object until we can fill it.
         clause.type.__dict__.update(self.ast[ctx.type_specifier()].__dict__)
+        dimensions = None
         if ctx.array_subscripts() is not None:
-            clause.dimensions = self.ast[ctx.array_subscripts()]
+            dimensions = self.ast[ctx.array_subscripts()]
+        elif len(clause.type.indices) > 0:
+            # The subscripts of array types, as in Real[n] x, end up in the
+            # component reference of the type.
+            dimensions = clause.type.indices
+            clause.type.indices = []
+        if dimensions is not None:
+            # The symbols were declared with the default dimensions of the
+            # clause, unless they have subscripts of their own.
+            for sym in self.comp_clause.symbol_list:
+                if sym.dimensions is clause.dimensions:
+                    sym.dimensions = dimensions
+            clause.dimensions = dimensions
 
         # We make sure that all references to the objects are unique per
         # symbol making copies. Note that if there is only one symbol in the
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Cost attribution for flattening.
+"""
+
+from __future__ import print_function, absolute_import, division, unicode_literals
+
+import functools
+import json
+import time
+from collections import OrderedDict
+from typing import Callable, List
+
+from . import ast
+
+REPORT_COLUMNS = ['function', 'class', 'modification', 'calls', 'inclusive', 'exclusive', 'nodes', 'deepcopies']
+
+
+class ProfileRecord(object):
+    """
+    Accumulated cost of calls to a flattening function for a single source
+    class and modification.
+    """
+
+    def __init__(self, function: str, class_name: str, modification: str):
+        self.function = function
+        self.class_name = class_name
+        self.modification = modification
+        self.calls = 0
+        self.inclusive = 0.0
+        self.exclusive = 0.0
+        self.nodes = 0
+        self.deepcopies = 0
+
+    def to_json(self) -> dict:
+        return OrderedDict([
+            ('function', self.function),
+            ('class', self.class_name),
+            ('modification', self.modification),
+            ('calls', self.calls),
+            ('inclusive', self.inclusive),
+            ('exclusive', self.exclusive),
+            ('nodes', self.nodes),
+            ('deepcopies', self.deepcopies)])
+
+
+class ProfileFrame(object):
+    def __init__(self, record: ProfileRecord, recursive: bool):
+        self.record = record
+        self.recursive = recursive
+        self.start = time.perf_counter()
+        self.children = 0.0
+
+
+class FlatteningProfiler(object):
+    """
+    Collects the wall time, call counts, allocated nodes and deep copies of
+    the flattening functions, per source class and per (class, modification)
+    pair.  Exclusive time, nodes and deep copies are attributed to the
+    innermost function call being measured.  Time spent in recursive calls
+    for the same class is only counted once in the inclusive time.
+    """
+
+    def __init__(self):
+        self.records = OrderedDict()  # type: OrderedDict[tuple, ProfileRecord]
+        self._stack = []  # type: List[ProfileFrame]
+
+    def enter(self, function: str, class_name: str, modification: str = '') -> None:
+        key = (function, class_name, modification)
+        record = self.records.get(key, None)
+        if record is None:
+            record = ProfileRecord(function, class_name, modification)
+            self.records[key] = record
+        recursive = any(frame.record is record for frame in self._stack)
+        self._stack.append(ProfileFrame(record, recursive))
+
+    def exit(self) -> None:
+        frame = self._stack.pop()
+        elapsed = time.perf_counter() - frame.start
+        frame.record.calls += 1
+        frame.record.exclusive += elapsed - frame.children
+        if not frame.recursive:
+            frame.record.inclusive += elapsed
+        if self._stack:
+            self._stack[-1].children += elapsed
+
+    def add_copy(self, node, deep=True) -> None:
+        """
+        Account for a copy of a tree made by the function being measured.
+        :param node: the copy
+        :param deep: whether the tree was copied as a whole, or only the top node
+        :return: None
+        """
+        if not self._stack or node is None:
+            return
+        record = self._stack[-1].record
+        if deep:
+            record.deepcopies += 1
+            record.nodes += count_nodes(node)
+        else:
+            record.nodes += 1
+
+    def summary(self, by_modification=False) -> List[ProfileRecord]:
+        """
+        :param by_modification: keep the records of different modifications of a class apart
+        :return: list of records, per function and class
+        """
+        if by_modification:
+            return list(self.records.values())
+
+        summary = OrderedDict()
+        for r in self.records.values():
+            s = summary.get((r.function, r.class_name), None)
+            if s is None:
+                s = ProfileRecord(r.function, r.class_name, '')
+                summary[(r.function, r.class_name)] = s
+            s.calls += r.calls
+            s.inclusive += r.inclusive
+            s.exclusive += r.exclusive
+            s.nodes += r.nodes
+            s.deepcopies += r.deepcopies
+        return list(summary.values())
+
+    def report(self, sort_by: str = 'exclusive', by_modification=False, limit: int = None) -> str:
+        """
+        Format the collected costs as a table.
+        :param sort_by: column to sort on, in descending order
+        :param by_modification: keep the records of different modifications of a class apart
+        :param limit: maximum number of rows
+        :return: report
+        """
+        if sort_by not in REPORT_COLUMNS:
+            raise ValueError('Unknown column {}'.format(sort_by))
+
+        rows = [r.to_json() for r in self.summary(by_modification)]
+        rows.sort(key=lambda r: r[sort_by], reverse=sort_by in REPORT_COLUMNS[3:])
+        if limit is not None:
+            rows = rows[:limit]
+
+        columns = REPORT_COLUMNS if by_modification else [c for c in REPORT_COLUMNS if c != 'modification']
+        lines = []
+        for row in rows:
+            line = []
+            for c in columns:
+                v = row[c]
+                if isinstance(v, float):
+                    line.append('{:.6f}'.format(v))
+                elif c == 'modification' and len(v) > 60:
+                    line.append(v[:57] + '...')
+                else:
+                    line.append(str(v))
+            lines.append(line)
+
+        widths = [max([len(c)] + [len(line[i]) for line in lines]) for i, c in enumerate(columns)]
+        return '\n'.join('  '.join(v.ljust(w) for v, w in zip(line, widths)).rstrip()
+                         for line in [columns] + lines)
+
+    def save(self, filename: str) -> None:
+        """
+        Write the collected costs to a JSON file.
+        :param filename: name of the file
+        :return: None
+        """
+        with open(filename, 'w') as f:
+            json.dump([r.to_json() for r in self.records.values()], f, indent=2)
+
+
+def count_nodes(node) -> int:
+    """
+    :param node: tree, or list or dictionary of trees
+    :return: number of AST nodes in the tree
+    """
+    n = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.Node):
+            n += 1
+            stack.extend(node.__dict__.values())
+        elif isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            stack.extend(node)
+    return n
+
+
+def class_name(class_or_sym) -> str:
+    """
+    :param class_or_sym: class, symbol, or None
+    :return: name identifying the source class
+    """
+    if isinstance(class_or_sym, ast.Class):
+        return '.'.join([str(w) for w in class_or_sym.within] + [class_or_sym.name])
+    elif isinstance(class_or_sym, ast.Symbol):
+        return str(class_or_sym.type)
+    else:
+        return ''
+
+
+def modification_key(modification) -> str:
+    """
+    :param modification: class modification, or None
+    :return: compact string representation of the modification
+    """
+    if modification is None:
+        return ''
+    return json.dumps(ast.Node.to_json(modification), sort_keys=True, separators=(',', ':'))
+
+
+def profiled(key: Callable) -> Callable:
+    """
+    Decorator measuring a flattening function with the profiler of the
+    collection that is passed as its first argument.
+    :param key: function returning the class name and modification key for the arguments of a call
+    :return: decorator
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(root, *args, **kwargs):
+            profiler = root._profiler
+            if profiler is None:
+                return f(root, *args, **kwargs)
+            profiler.enter(f.__name__, *key(root, *args, **kwargs))
+            try:
+                return f(root, *args, **kwargs)
+            finally:
+                profiler.exit()
+        return wrapper
+    return decorator
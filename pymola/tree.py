@@ -7,16 +7,26 @@ from __future__ import print_function, absolute_import, division, unicode_litera
 
 import numpy as np
 import copy
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import math
 import copy # TODO
+import os
+import pickle
 import sys
-from collections import OrderedDict
-from typing import Union
+from collections import OrderedDict, namedtuple
+from typing import Dict, Iterator, List, Set, Union
 
-from . import ast
+from . import ast, __version__
+from .profiler import FlatteningProfiler, class_name, modification_key, profiled
 
 CLASS_SEPARATOR = '.'
 
+ConnectorVariable = namedtuple('ConnectorVariable', ['name', 'prefixes', 'dimensions'])
+
 logger = logging.getLogger("pymola")
 
 
@@ -177,9 +187,92 @@ class TreeListener(object):
         pass
 
 
+def descendant_types(node_type: type) -> Union[Set[type], None]:
+    """
+    :param node_type: type of AST node
+    :return: the node types that can appear anywhere below a node of this type,
+        or None if any node type can
+    """
+    if node_type not in _descendant_types:
+        descendants = set()
+        stack = [node_type]
+        while stack:
+            child_types = ast.CHILD_TYPES.get(stack.pop(), None)
+            if child_types is None:
+                descendants = None
+                break
+            for child_type in child_types:
+                if child_type not in descendants:
+                    descendants.add(child_type)
+                    stack.append(child_type)
+        _descendant_types[node_type] = descendants
+    return _descendant_types[node_type]
+
+
+def listener_node_types(listener_class: type) -> Union[Set[type], None]:
+    """
+    :param listener_class: class of a tree listener
+    :return: the node types for which the listener defines callbacks,
+        or None if it handles every node
+    """
+    def overrides(method_name):
+        return getattr(listener_class, method_name, None) is not getattr(TreeListener, method_name, None)
+
+    if overrides('enterEvery') or overrides('exitEvery'):
+        return None
+
+    node_types = set()
+    for method_name in dir(listener_class):
+        if method_name.startswith('enter'):
+            node_name = method_name[len('enter'):]
+        elif method_name.startswith('exit'):
+            node_name = method_name[len('exit'):]
+        else:
+            continue
+        if overrides(method_name):
+            node_type = getattr(ast, node_name, None)
+            if not (isinstance(node_type, type) and issubclass(node_type, ast.Node)):
+                return None
+            node_types.add(node_type)
+    return node_types
+
+
+def must_visit(listener_class: type, node_type: type) -> bool:
+    """
+    Determine whether a walk has to visit a node, i.e., whether the listener
+    defines callbacks for the node, or for any node that can appear below it.
+    :param listener_class: class of the tree listener
+    :param node_type: type of AST node
+    :return: True if the node has to be visited
+    """
+    key = (listener_class, node_type)
+    visit = _visited_types.get(key, None)
+    if visit is None:
+        if listener_class not in _listener_node_types:
+            _listener_node_types[listener_class] = listener_node_types(listener_class)
+        node_types = _listener_node_types[listener_class]
+        if node_types is None or node_type in node_types:
+            visit = True
+        else:
+            descendants = descendant_types(node_type)
+            visit = descendants is None or not descendants.isdisjoint(node_types)
+        _visited_types[key] = visit
+    return visit
+
+
+_descendant_types = {}
+_listener_node_types = {}
+_visited_types = {}
+
+
 class TreeWalker(object):
     """
     Defines methods for tree walker. Inherit from this to make your own.
+
+    Sub-trees that cannot contain any node for which the listener defines
+    callbacks, as determined from the node types that can appear below each
+    node type, are skipped.  The context of the listener is not updated
+    within skipped sub-trees.
     """
 
     def walk(self, listener: TreeListener, tree: ast.Node) -> None:
@@ -195,7 +288,9 @@ class TreeWalker(object):
         if hasattr(listener, 'enter' + name):
             getattr(listener, 'enter' + name)(tree)
         for child_name in tree.__dict__.keys():
-            self.handle_walk(listener, tree.__dict__[child_name])
+            # Attributes starting with an underscore hold bookkeeping, not tree data
+            if not child_name.startswith('_'):
+                self.handle_walk(listener, tree.__dict__[child_name])
         if hasattr(listener, 'exitEvery'):
             getattr(listener, 'exitEvery')(tree)
         if hasattr(listener, 'exit' + name):
@@ -209,7 +304,8 @@ class TreeWalker(object):
         :return: None
         """
         if isinstance(tree, ast.Node):
-            self.walk(listener, tree)
+            if must_visit(type(listener), type(tree)):
+                self.walk(listener, tree)
         elif isinstance(tree, dict):
             for k in tree.keys():
                 self.handle_walk(listener, tree[k])
@@ -220,9 +316,173 @@ class TreeWalker(object):
             pass
 
 
+FlatInstance = namedtuple('FlatInstance', ['signature', 'classes', 'flat_class'])
+FlatFunction = namedtuple('FlatFunction', ['classes', 'flat_class', 'functions'])
+FlatComponent = namedtuple('FlatComponent', ['symbols', 'functions', 'equations', 'initial_equations'])
+
+
+class DependencyGraph(object):
+    """
+    Records, for every component instance of a flattened model, the source
+    classes it was derived from and the result of flattening it.  Given the
+    graph of a previous flattening and a set of changed classes, instances
+    that depend on none of the changed classes are reused instead of being
+    flattened again.
+    """
+
+    def __init__(self, previous: 'DependencyGraph' = None, changed_classes: list = None, vectorize_arrays=False):
+        self.classes = set()  # type: Set[tuple]
+        self.vectorize_arrays = vectorize_arrays
+        self.instances = OrderedDict()  # type: OrderedDict[str, FlatInstance]
+        self.reused = []  # type: List[str]
+        self._class_digests = {}  # type: Dict[tuple, str]
+
+        if previous is None or changed_classes is None:
+            self._previous = {}
+        else:
+            self._previous = previous.instances
+        self._changed = [tuple(c.split(CLASS_SEPARATOR)) if isinstance(c, str) else c.to_tuple()
+                         for c in (changed_classes or [])]
+
+    def is_affected(self, classes: set) -> bool:
+        """
+        Check whether a set of class names is affected by the changed classes.
+        A class is affected when it, or one of the classes enclosing it or
+        nested in it, has changed.
+        :param classes: set of fully scoped class name tuples
+        :return: True if any of the classes is affected
+        """
+        for c in classes:
+            for changed in self._changed:
+                n = min(len(c), len(changed))
+                if c[:n] == changed[:n]:
+                    return True
+        return False
+
+    def dependencies(self, instance_name: str) -> set:
+        """
+        :param instance_name: name of a component instance of the flattened class
+        :return: set of fully scoped names of the classes the instance depends on
+        """
+        return set(CLASS_SEPARATOR.join(c) for c in self.instances[instance_name].classes)
+
+    def signature(self, root: ast.Collection, sym: ast.Symbol, classes: set) -> Union[str, None]:
+        """
+        :param root: collection for performing class lookup
+        :param sym: the (name mangled) symbol declaring an instance
+        :param classes: set of fully scoped names of the classes the instance depends on
+        :return: hash of the declaration of the instance and of the classes it depends on, or None if any
+            of the classes does not exist
+        """
+        closure_hash = class_closure_hash(root, classes, self._class_digests)
+        if closure_hash is None:
+            return None
+        declaration = {k: v for k, v in ast.Node.to_json(sym).items() if k not in ['id', 'order', 'comment']}
+
+        # Vectorization changes the layout of arrays of instances
+        declaration['vectorize_arrays'] = self.vectorize_arrays
+        h = hashlib.sha1(json.dumps(declaration, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        h.update(closure_hash.encode('utf-8'))
+        return h.hexdigest()
+
+    def reuse_instance(self, root: ast.Collection, sym: ast.Symbol) -> FlatInstance:
+        """
+        Look up a component instance in the previous flattening.  It can be
+        reused if neither the declaration of the instance nor any of the
+        classes it depends on have changed.  The flattened class of the
+        instance is shared with the previous flattening, and needs to be
+        copied before it is used.
+        :param root: collection for performing class lookup
+        :param sym: the (name mangled) symbol declaring the instance
+        :return: the previously flattened instance, or None
+        """
+        previous = self._previous.get(sym.name, None)
+        if previous is None or self.is_affected(previous.classes) or \
+                previous.signature != self.signature(root, sym, previous.classes):
+            return None
+        self.instances[sym.name] = previous
+        self.reused.append(sym.name)
+        return previous
+
+    def add_instance(self, root: ast.Collection, sym: ast.Symbol, classes: set, flat_class: ast.Class) -> None:
+        """
+        Record a flattened component instance.
+        :param root: collection for performing class lookup
+        :param sym: the (name mangled) symbol declaring the instance
+        :param classes: set of fully scoped names of the classes the instance depends on
+        :param flat_class: copy of the flattened class of the instance, that is not modified any further
+        :return: None
+        """
+        signature = self.signature(root, sym, classes)
+        if signature is not None:
+            self.instances[sym.name] = FlatInstance(signature, classes, flat_class)
+
+
+class InstanceArrayIndexer(TreeListener):
+    """
+    Adds the loop index of an array of component instances to all references
+    to the members of the instances.
+    """
+
+    def __init__(self, symbols: dict, index_name: str):
+        self.symbols = symbols
+        self.index_name = index_name
+        super().__init__()
+
+    def enterComponentRef(self, tree: ast.ComponentRef):
+        if tree.name in self.symbols:
+            tree.indices = [ast.ComponentRef(name=self.index_name)] + tree.indices
+
+
+def is_vectorizable(flat_sym: ast.Symbol, c: ast.Class, flat_sub_class: ast.Class) -> bool:
+    """
+    Check whether the equations of an array of component instances can be kept
+    as a single set of equations, looping over the instances.  This is the case
+    for one-dimensional arrays of instances that have scalar members and plain
+    equations only.
+    :param flat_sym: the (name mangled) symbol declaring the instances
+    :param c: class of the instances
+    :param flat_sub_class: the flattened class of the instances
+    :return: True if the equations of the instances can be vectorized
+    """
+    if c.type == 'connector' or len(flat_sym.dimensions) != 1:
+        return False
+    dimension = flat_sym.dimensions[0]
+    if isinstance(dimension, ast.Primary) and dimension.value == 1:
+        return False
+    # Scalar members carry the dimensions of the instance array only
+    dimensions = repr(flat_sym.dimensions)
+    if any(repr(s.dimensions) != dimensions for s in flat_sub_class.symbols.values()):
+        return False
+    return all(type(e) is ast.Equation for e in itertools.chain(
+        flat_sub_class.equations, flat_sub_class.initial_equations))
+
+
+def vectorize_equations(symbols: dict, for_index: ast.ForIndex, equations: list) -> list:
+    """
+    Wrap the equations of an array of component instances in a for loop over
+    the instances.
+    :param symbols: the members of the instances
+    :param for_index: loop index ranging over the instances
+    :param equations: equations of the instances
+    :return: list containing the for equation, or an empty list
+    """
+    if len(equations) == 0:
+        return []
+    equations = copy.deepcopy(equations)
+    w = TreeWalker()
+    indexer = InstanceArrayIndexer(symbols, for_index.name)
+    for equation in equations:
+        w.walk(indexer, equation)
+    return [ast.ForEquation(indices=[for_index], equations=equations)]
+
+
+@profiled(lambda root, orig_class, instance_name, class_modification=None, *args, **kwargs:
+          (class_name(orig_class), modification_key(class_modification)))
 def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: str,
                   class_modification: ast.ClassModification = None,
-                  flatten_symbols=True) -> ast.Class:
+                  flatten_symbols=True, dependency_graph: DependencyGraph = None,
+                  vectorize_arrays=False) -> ast.Class:
     """
     This function takes and flattens it so that all subclasses instances
     are replaced by the their equations and symbols with name mangling
@@ -232,20 +492,43 @@ def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: st
     :param instance_name:
     :param class_modification:
     :param flatten_symbols:
+    :param dependency_graph: graph in which to record the dependencies of the component instances
+    :param vectorize_arrays: keep the equations of arrays of component instances
+        as a single for loop over the instances
     :return: flat_class, the flattened class of type Class
     """
 
+    extended_orig_class = extend_class(root, orig_class, class_modification)
+
+    if extended_orig_class.type == "__builtin":
+         return extended_orig_class
+
+    if not flatten_symbols:
+        return extended_orig_class
+
     # create the returned class
     flat_class = ast.Class(
         name=orig_class.name,
         type=orig_class.type,
     )
 
-    # append period to non empty instance_name
-    if instance_name != '':
-        instance_prefix = instance_name + CLASS_SEPARATOR
-    else:
-        instance_prefix = instance_name
+    for _ in flatten_components(root, orig_class, extended_orig_class, flat_class, instance_name,
+                                dependency_graph=dependency_graph, vectorize_arrays=vectorize_arrays):
+        pass
+
+    return flat_class
+
+
+def extend_class(root: ast.Collection, orig_class: ast.Class,
+                 class_modification: ast.ClassModification = None) -> ast.Class:
+    """
+    Merge the parent classes of a class into it, and apply the class
+    modification.  Local classes are flattened, but the symbols are not.
+    :param root: The root of the tree that contains all class definitions
+    :param orig_class: The class to extend
+    :param class_modification: modification to apply to the extended class
+    :return: the extended class
+    """
 
     extended_orig_class = ast.Class(
         name=orig_class.name,
@@ -274,9 +557,11 @@ def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: st
             flat_parent_class = flatten_class(root, c, '', flatten_symbols=False)
 
             # set visibility
-            for sym in flat_parent_class.symbols.values():
+            for sym_name, sym in flat_parent_class.symbols.items():
                 if sym.visibility > extends.visibility:
+                    sym = copy_on_write(sym)
                     sym.visibility = extends.visibility
+                    flat_parent_class.symbols[sym_name] = sym
 
             # add parent class members symbols, equations and statements
             extended_orig_class.classes.update(flat_parent_class.classes)
@@ -310,54 +595,141 @@ def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: st
     for class_name, c in extended_orig_class.classes.items():
         extended_orig_class.classes[class_name] = flatten_class(root, c, '')
 
-    if extended_orig_class.type == "__builtin":
-         return extended_orig_class
+    return extended_orig_class
 
-    if not flatten_symbols:
-        return extended_orig_class
+
+def flatten_components(root: ast.Collection, orig_class: ast.Class, extended_orig_class: ast.Class,
+                       flat_class: ast.Class, instance_name: str, dependency_graph: DependencyGraph = None,
+                       vectorize_arrays=False, keep_equations=True, in_place=False) -> Iterator[FlatComponent]:
+    """
+    Flatten the symbols of an extended class into flat_class.  This is a
+    generator that yields every component as soon as it has been merged into
+    flat_class.  The references between the components, and the equations of
+    the class itself, are resolved after the last component.
+    :param root: The root of the tree that contains all class definitions
+    :param orig_class: The class we want to flatten
+    :param extended_orig_class: orig_class, as returned by extend_class
+    :param flat_class: the class to merge the flattened components into
+    :param instance_name:
+    :param dependency_graph: graph in which to record the dependencies of the component instances
+    :param vectorize_arrays: keep the equations of arrays of component instances
+        as a single for loop over the instances
+    :param keep_equations: merge the equations of the components into flat_class.
+        Connect clauses are always merged.
+    :param in_place: resolve the references in the symbols of flat_class in place,
+        instead of replacing the symbols with resolved copies
+    :return: generator of the flattened components
+    """
+
+    # append period to non empty instance_name
+    if instance_name != '':
+        instance_prefix = instance_name + CLASS_SEPARATOR
+    else:
+        instance_prefix = instance_name
+
+    # loop indices of vectorized arrays of component instances
+    vectorized_indices = []
+
+    # A set of component refs to functions
+    pulled_functions = OrderedDict()
+    w = TreeWalker()
 
     # for all symbols in the original class
     for sym_name, sym in extended_orig_class.symbols.items():
         flat_sym = flatten_symbol(sym, instance_prefix)
+        if root._profiler is not None:
+            root._profiler.add_copy(flat_sym)
+
+        # Function calls in the declaration, e.g., in its value or
+        # modifications, are made relative to this class.
+        w.walk(FunctionExpander(root, orig_class.within, pulled_functions), flat_sym)
+
+        # Record all classes that the instance depends on
+        classes = set()
+        if dependency_graph is not None:
+            root._lookup_logs.append(classes)
+
         try:
             # First try a lookup in the local classes
             c = copy.deepcopy(extended_orig_class.classes.get(sym.type.name, None))
+            if root._profiler is not None:
+                root._profiler.add_copy(c)
 
             # If not found, do a lookup in the class tree
             if c is None:
                 c = root.find_class(sym.type, orig_class.within)
+            else:
+                # Local classes change along with the class being flattened,
+                # so we do not reuse instances of them.
+                classes = None
 
             if c.type == "__builtin":
                 flat_class.symbols[flat_sym.name] = flat_sym
                 for att in flat_sym.ATTRIBUTES + ["type"]:
                     setattr(flat_class.symbols[flat_sym.name], att, getattr(c.symbols['__value'], att))
 
+                yield FlatComponent([flat_sym], OrderedDict(), [], [])
                 continue
 
         except KeyError:
             # append original symbol to flat class
             flat_class.symbols[flat_sym.name] = flat_sym
+            yield FlatComponent([flat_sym], OrderedDict(), [], [])
         else:
-            # recursively call flatten on the contained class
-            flat_sub_class = flatten_class(root, c, flat_sym.name, flat_sym.class_modification)
-
-            # carry class dimensions over to symbols
-            for flat_class_symbol in flat_sub_class.symbols.values():
-                if len(flat_class_symbol.dimensions) == 1 \
-                        and isinstance(flat_class_symbol.dimensions[0], ast.Primary) \
-                        and flat_class_symbol.dimensions[0].value == 1:
-                    flat_class_symbol.dimensions = flat_sym.dimensions
-                elif len(flat_sym.dimensions) == 1 and isinstance(flat_sym.dimensions[0], ast.Primary) \
-                        and flat_sym.dimensions[0].value == 1:
-                    flat_class_symbol.dimensions = flat_class_symbol.dimensions
-                else:
-                    flat_class_symbol.dimensions = flat_sym.dimensions + flat_class_symbol.dimensions
+            track_instance = dependency_graph is not None and classes is not None
+
+            flat_instance = dependency_graph.reuse_instance(root, flat_sym) if track_instance else None
+            if flat_instance is not None:
+                # The later passes modify the symbols and equations in place
+                flat_sub_class = copy.deepcopy(flat_instance.flat_class)
+                if root._profiler is not None:
+                    root._profiler.add_copy(flat_sub_class)
+                for lookup_log in root._lookup_logs:
+                    lookup_log.update(flat_instance.classes)
+            else:
+                # recursively call flatten on the contained class
+                flat_sub_class = flatten_class(root, c, flat_sym.name, flat_sym.class_modification,
+                                               vectorize_arrays=vectorize_arrays)
+
+                # carry class dimensions over to symbols
+                for flat_class_symbol in flat_sub_class.symbols.values():
+                    if len(flat_class_symbol.dimensions) == 1 \
+                            and isinstance(flat_class_symbol.dimensions[0], ast.Primary) \
+                            and flat_class_symbol.dimensions[0].value == 1:
+                        flat_class_symbol.dimensions = flat_sym.dimensions
+                    elif len(flat_sym.dimensions) == 1 and isinstance(flat_sym.dimensions[0], ast.Primary) \
+                            and flat_sym.dimensions[0].value == 1:
+                        flat_class_symbol.dimensions = flat_class_symbol.dimensions
+                    else:
+                        flat_class_symbol.dimensions = flat_sym.dimensions + flat_class_symbol.dimensions
+
+                if track_instance:
+                    flat_instance_class = copy.deepcopy(flat_sub_class)
+                    if root._profiler is not None:
+                        root._profiler.add_copy(flat_instance_class)
+                    dependency_graph.add_instance(root, flat_sym, classes, flat_instance_class)
 
             # add sub_class members symbols and equations
             flat_class.classes.update(flat_sub_class.classes)
             flat_class.symbols.update(flat_sub_class.symbols)
-            flat_class.equations += flat_sub_class.equations
-            flat_class.initial_equations += flat_sub_class.initial_equations
+            if vectorize_arrays and is_vectorizable(flat_sym, c, flat_sub_class):
+                index_name = flat_sym.name.replace(CLASS_SEPARATOR, '_') + '_index'
+                for_index = ast.ForIndex(name=index_name, expression=ast.Slice(
+                    start=ast.Primary(value=1), stop=copy.deepcopy(flat_sym.dimensions[0]), step=ast.Primary(value=1)))
+                vectorized_indices.append(for_index)
+                equations = vectorize_equations(
+                    flat_sub_class.symbols, for_index, flat_sub_class.equations)
+                initial_equations = vectorize_equations(
+                    flat_sub_class.symbols, for_index, flat_sub_class.initial_equations)
+            else:
+                equations = flat_sub_class.equations
+                initial_equations = flat_sub_class.initial_equations
+            if keep_equations:
+                flat_class.equations += equations
+                flat_class.initial_equations += initial_equations
+            else:
+                # connect clauses can only be expanded once all connectors are known
+                flat_class.equations += [e for e in equations if isinstance(e, ast.ConnectClause)]
             flat_class.statements += flat_sub_class.statements
             flat_class.initial_statements += flat_sub_class.initial_statements
             flat_class.functions.update(flat_sub_class.functions)
@@ -368,13 +740,23 @@ def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: st
                 flat_sym.__connector_type = c
                 flat_class.symbols[flat_sym.name] = flat_sym
 
+            yield FlatComponent(list(flat_sub_class.symbols.values()), flat_sub_class.functions,
+                                equations, initial_equations)
+        finally:
+            if dependency_graph is not None:
+                root._lookup_logs.pop()
+
     # now resolve all references inside the symbol definitions
     for sym_name, sym in flat_class.symbols.items():
         flat_sym = flatten_component_refs(root, flat_class, sym, instance_prefix)
-        flat_class.symbols[sym_name] = flat_sym
+        if in_place:
+            sym.__dict__.update(flat_sym.__dict__)
+        else:
+            flat_class.symbols[sym_name] = flat_sym
 
-    # A set of component refs to functions
-    pulled_functions = OrderedDict()
+    # the loop ranges refer to the same symbols as the array dimensions
+    for for_index in vectorized_indices:
+        for_index.expression = flatten_component_refs(root, flat_class, for_index.expression, instance_prefix)
 
     # for all equations in original class
     for equation in extended_orig_class.equations:
@@ -406,29 +788,81 @@ def flatten_class(root: ast.Collection, orig_class: ast.Class, instance_name: st
     flat_class.initial_statements += \
         [flatten_component_refs(root, flat_class, e, instance_prefix) for e in fs_initial_statements]
 
-    # TODO: Make sure we also pull in any functions called in functions in function_set
-    # TODO: Also do functions in statements, initial_statements, and initial_equations
-
+    # Functions called from the pulled functions are pulled in as well
     for f, c in pulled_functions.items():
-        pulled_functions[f] = flatten_class(root, c, '')
-        c = pulled_functions[f]
-        flat_class.functions.update(c.functions)
-        c.functions = OrderedDict()
+        flat_function = flatten_function(root, f, c)
+        flat_class.functions.update(flat_function.functions)
+        pulled_functions[f] = flat_function.flat_class
 
     flat_class.functions.update(pulled_functions)
 
-    return flat_class
 
+def flatten_function(root: ast.Collection, function_name: str, function_class: ast.Class) -> FlatFunction:
+    """
+    Flatten a function.  Within a call to flatten, every function is only
+    flattened once, no matter how many instances call it.
+    :param root: The root of the tree that contains all class definitions
+    :param function_name: fully scoped name of the function
+    :param function_class: the function
+    :return: the flattened function, and the functions called from it
+    """
+    flat_functions = root._flat_functions
+    flat_function = flat_functions.get(function_name, None) if flat_functions is not None else None
+
+    if flat_function is None:
+        classes = set()
+        root._lookup_logs.append(classes)
+        try:
+            flat_class = flatten_class(root, function_class, '')
+        finally:
+            root._lookup_logs.pop()
+
+        # Functions called from the function are moved next to it
+        flat_function = FlatFunction(classes, flat_class, flat_class.functions)
+        flat_class.functions = OrderedDict()
+
+        if flat_functions is not None:
+            flat_functions[function_name] = flat_function
+
+    for lookup_log in root._lookup_logs:
+        lookup_log.update(flat_function.classes)
 
+    return flat_function
+
+
+def copy_on_write(class_or_sym: Union[ast.Class, ast.Symbol]) -> Union[ast.Class, ast.Symbol]:
+    """
+    Make a shallow copy of a class or symbol.  The element containers of a
+    class are copied, but the elements themselves are shared with the original
+    until they are replaced by a modified copy.
+    :param class_or_sym: class or symbol to copy
+    :return: copy of class or symbol
+    """
+    c = copy.copy(class_or_sym)
+    if isinstance(c, ast.Class):
+        for attr in ['classes', 'symbols', 'functions']:
+            setattr(c, attr, OrderedDict(getattr(c, attr)))
+        for attr in ['imports', 'extends', 'equations', 'initial_equations', 'statements', 'initial_statements']:
+            setattr(c, attr, getattr(c, attr)[:])
+    else:
+        c.prefixes = c.prefixes[:]
+    return c
+
+
+@profiled(lambda root, class_or_sym, modification, *args, **kwargs:
+          (class_name(class_or_sym), modification_key(modification)))
 def modify_class(root: ast.Collection, class_or_sym: Union[ast.Class, ast.Symbol], modification, within=[]):
     """
-    Apply a modification to a class or symbol.
+    Apply a modification to a class or symbol.  The input is left untouched;
+    only the elements that are actually modified are copied.
     :param root: root tree for looking up symbols
     :param class_or_sym: class or symbol to modify
     :param modification: modification to apply
     :return:
     """
-    class_or_sym = copy.deepcopy(class_or_sym)
+    class_or_sym = copy_on_write(class_or_sym)
+    if root._profiler is not None:
+        root._profiler.add_copy(class_or_sym, deep=False)
     for argument in modification.arguments:
         if isinstance(argument, ast.ElementModification):
             if argument.component.name in ast.Symbol.ATTRIBUTES:
@@ -438,10 +872,23 @@ def modify_class(root: ast.Collection, class_or_sym: Union[ast.Class, ast.Symbol
                     # First we check the local class definitions
                     s = class_or_sym.classes.get(argument.component.name, None)
                     if s is None:
-                        s = root.find_symbol(class_or_sym, argument.component)
-                    elif s.type == "__builtin":
-                        # We need to do any modifications on the containing symbol
-                        s = s.symbols['__value']
+                        s = copy_on_write(class_or_sym.symbols[argument.component.name])
+                        class_or_sym.symbols[s.name] = s
+                        if argument.component.child:
+                            # Pass modifications of nested elements on to the
+                            # component, i.e., 'a.b(c = 1)' becomes 'a(b(c = 1))'.
+                            nested_argument = ast.ElementModification(
+                                component=argument.component.child[0], modifications=argument.modifications)
+                            s.class_modification = ast.ClassModification(
+                                arguments=(s.class_modification.arguments if s.class_modification else []) + [nested_argument])
+                            continue
+                    else:
+                        s = copy_on_write(s)
+                        class_or_sym.classes[argument.component.name] = s
+                        if s.type == "__builtin":
+                            # We need to do any modifications on the containing symbol
+                            s.symbols['__value'] = copy_on_write(s.symbols['__value'])
+                            s = s.symbols['__value']
                 else:
                     s = root.find_symbol(class_or_sym, argument.component)
 
@@ -452,8 +899,9 @@ def modify_class(root: ast.Collection, class_or_sym: Union[ast.Class, ast.Symbol
                         s.value = modification
         elif isinstance(argument, ast.ComponentClause):
             for new_sym in argument.symbol_list:
-                orig_sym = class_or_sym.symbols[new_sym.name]
+                orig_sym = copy.copy(class_or_sym.symbols[new_sym.name])
                 orig_sym.__dict__.update(new_sym.__dict__)
+                class_or_sym.symbols[new_sym.name] = orig_sym
         elif isinstance(argument, ast.ShortClassDefinition):
             class_or_sym.classes[argument.name] = root.find_class(argument.component, within)
         else:
@@ -469,7 +917,7 @@ def flatten_symbol(s: ast.Symbol, instance_prefix: str) -> ast.Symbol:
     :return: flattened symbol
     """
     s_copy = copy.deepcopy(s)
-    s_copy.name = instance_prefix + s.name
+    s_copy.name = sys.intern(instance_prefix + s.name)
     if len(instance_prefix) > 0:
         # Strip 'input' and 'output' prefixes from nested symbols.
         strip_keywords = ['input', 'output']
@@ -517,7 +965,7 @@ class ComponentRefFlattener(TreeListener):
             # reference alone.
             self.cutoff_depth = self.depth
         else:
-            tree.name = new_name
+            tree.name = sys.intern(new_name)
             c = tree
             while len(c.child) > 0:
                 c = c.child[0]
@@ -531,6 +979,7 @@ class ComponentRefFlattener(TreeListener):
             self.cutoff_depth = sys.maxsize
 
 
+@profiled(lambda root, container, *args, **kwargs: (class_name(container), ''))
 def flatten_component_refs(
         root: ast.Collection, container: ast.Class,
         expression: ast.Union[ast.ConnectClause, ast.AssignmentStatement, ast.ForStatement, ast.Symbol],
@@ -545,6 +994,8 @@ def flatten_component_refs(
     """
 
     expression_copy = copy.deepcopy(expression)
+    if root._profiler is not None:
+        root._profiler.add_copy(expression_copy)
 
     w = TreeWalker()
     w.walk(ComponentRefFlattener(root, container, instance_prefix), expression_copy)
@@ -552,6 +1003,90 @@ def flatten_component_refs(
     return expression_copy
 
 
+class ConnectionSets(object):
+    """
+    Disjoint-set forest over connector variable keys, used to collect the
+    connection sets of flow variables.  Every set keeps its members in a
+    linked list, so that merging two sets does not touch their members.
+    Sets are iterated in the order in which their first member was added.
+    """
+
+    def __init__(self):
+        self._parent = OrderedDict()
+        self._rank = {}
+        self._payload = {}
+        self._next = {}
+        self._head = {}
+        self._tail = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self._parent
+
+    def add(self, key, payload) -> None:
+        """
+        Add a key as a singleton set, or update the payload of an existing key.
+        :param key: hashable key of the connector variable
+        :param payload: data to return for this key when iterating
+        :return: None
+        """
+        self._payload[key] = payload
+        if key not in self._parent:
+            self._parent[key] = key
+            self._rank[key] = 0
+            self._next[key] = None
+            self._head[key] = key
+            self._tail[key] = key
+
+    def find(self, key):
+        parent = self._parent
+        while parent[key] != key:
+            # Path halving
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(self, a, b) -> None:
+        """
+        Merge the sets containing a and b.  The members of the set of b are
+        ordered after those of the set of a.
+        :param a: key in the first set
+        :param b: key in the second set
+        :return: None
+        """
+        root_a = self.find(a)
+        root_b = self.find(b)
+        if root_a == root_b:
+            return
+
+        head, tail = self._head.pop(root_a), self._tail.pop(root_b)
+        self._next[self._tail.pop(root_a)] = self._head.pop(root_b)
+
+        if self._rank[root_a] < self._rank[root_b]:
+            root_a, root_b = root_b, root_a
+        elif self._rank[root_a] == self._rank[root_b]:
+            self._rank[root_a] += 1
+        self._parent[root_b] = root_a
+
+        self._head[root_a] = head
+        self._tail[root_a] = tail
+
+    def __iter__(self):
+        seen = set()
+        for key in self._parent:
+            root = self.find(key)
+            if root in seen:
+                continue
+            seen.add(root)
+
+            members = []
+            member = self._head[root]
+            while member is not None:
+                members.append(self._payload[member])
+                member = self._next[member]
+            yield members
+
+
+@profiled(lambda root, node: (class_name(node), ''))
 def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
     # keep track of which flow variables have been connected to, and which ones haven't
     disconnected_flow_variables = OrderedDict()
@@ -559,9 +1094,36 @@ def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
         if 'flow' in sym.prefixes:
             disconnected_flow_variables[sym.name] = sym
 
+    # The same few connector types are typically connected many times, so we
+    # only look up and flatten every connector type once.  Connector symbols
+    # carry copies of their class, so the classes are keyed by type name.
+    connector_types = {}
+    connector_interfaces = {}
+
+    def find_connector_type(sym):
+        type_tuple = sym.type.to_tuple()
+        if type_tuple not in connector_types:
+            c = getattr(sym, '__connector_type', None)
+            if c is None:
+                try:
+                    c = root.find_class(sym.type)
+                except KeyError:
+                    pass
+            connector_types[type_tuple] = c
+        if connector_types[type_tuple] is None:
+            raise KeyError
+        return type_tuple
+
+    def connector_interface(type_tuple):
+        if type_tuple not in connector_interfaces:
+            flat_class = flatten_class(root, connector_types[type_tuple], '')
+            connector_interfaces[type_tuple] = [ConnectorVariable(s.name, s.prefixes, s.dimensions)
+                                                for s in flat_class.symbols.values()]
+        return connector_interfaces[type_tuple]
+
     # add flow equations
     # for all equations in original class
-    flow_connections = OrderedDict()
+    flow_connections = ConnectionSets()
     orig_equations = node.equations[:]
     node.equations = []
     for equation in orig_equations:
@@ -571,15 +1133,10 @@ def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
             sym_right = root.find_symbol(node, equation.right)
 
             try:
-                class_left = getattr(sym_left, '__connector_type', None)
-                if class_left is None:
-                    # We may be connecting classes which are not connectors, such as Reals.
-                    class_left = root.find_class(sym_left.type)
+                # We may be connecting classes which are not connectors, such as Reals.
+                type_left = find_connector_type(sym_left)
                 # noinspection PyUnusedLocal
-                class_right = getattr(sym_right, '__connector_type', None)
-                if class_right is None:
-                    # We may be connecting classes which are not connectors, such as Reals.
-                    class_right = root.find_class(sym_right.type)
+                type_right = find_connector_type(sym_right)
             except KeyError:
                 primary_types = ['Real']
                 # TODO
@@ -591,9 +1148,7 @@ def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
             else:
                 # TODO: Add check about matching inputs and outputs
 
-                flat_class_left = flatten_class(root, class_left, '')
-
-                for connector_variable in flat_class_left.symbols.values():
+                for connector_variable in connector_interface(type_left):
                     left_name = equation.left.name + CLASS_SEPARATOR + connector_variable.name
                     right_name = equation.right.name + CLASS_SEPARATOR + connector_variable.name
                     left = ast.ComponentRef(name=left_name, indices=equation.left.indices)
@@ -606,16 +1161,13 @@ def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
                         left_key = (left_name, tuple(i.value for i in left.indices), equation.__left_inner)
                         right_key = (right_name, tuple(i.value for i in right.indices), equation.__right_inner)
 
-                        left_connected_variables = flow_connections.get(left_key, OrderedDict())
-                        right_connected_variables = flow_connections.get(right_key, OrderedDict())
+                        # Members of existing connection sets go first, followed
+                        # by the variables that have not been connected before.
+                        keys = sorted([left_key, right_key], key=lambda k: k not in flow_connections)
 
-                        left_connected_variables.update(right_connected_variables)
-                        connected_variables = left_connected_variables
-                        connected_variables[left_key] = (left, equation.__left_inner)
-                        connected_variables[right_key] = (right, equation.__right_inner)
-
-                        for connected_variable in connected_variables:
-                            flow_connections[connected_variable] = connected_variables
+                        flow_connections.add(left_key, (left, equation.__left_inner))
+                        flow_connections.add(right_key, (right, equation.__right_inner))
+                        flow_connections.union(*keys)
 
                         # TODO When dealing with an array of connectors, we can lose
                         # disconnected flow variables in this way.  We don't initialize
@@ -629,21 +1181,20 @@ def expand_connectors(root: ast.Collection, node: ast.Node) -> None:
         else:
             node.equations.append(equation)
 
-    processed = []  # OrderedDict is not hashable, so we cannot use sets.
-    for connected_variables in flow_connections.values():
-        if connected_variables not in processed:
-            operand_specs = list(connected_variables.values())
-            if np.all([not op_spec[1] for op_spec in operand_specs]):
-                # All outer variables. Don't include unnecessary minus expressions.
-                operands = [op_spec[0] for op_spec in operand_specs]
-            else:
-                operands = [op_spec[0] if op_spec[1] else ast.Expression(operator='-', operands=[op_spec[0]]) for op_spec in operand_specs]
-            expr = operands[-1]
-            for op in reversed(operands[:-1]):
-                expr = ast.Expression(operator='+', operands=[op, expr])
-            connect_equation = ast.Equation(left=expr, right=ast.Primary(value=0))
-            node.equations.append(connect_equation)
-            processed.append(connected_variables)
+    for operand_specs in flow_connections:
+        if np.all([not op_spec[1] for op_spec in operand_specs]):
+            # All outer variables. Don't include unnecessary minus expressions.
+            operands = [op_spec[0] for op_spec in operand_specs]
+        else:
+            operands = [op_spec[0] if op_spec[1] else ast.Expression(operator='-', operands=[op_spec[0]]) for op_spec in operand_specs]
+        # A single n-ary sum keeps the expression tree flat, no matter how
+        # many variables are in the connection set.
+        if len(operands) > 1:
+            expr = ast.Expression(operator='+', operands=operands)
+        else:
+            expr = operands[0]
+        connect_equation = ast.Equation(left=expr, right=ast.Primary(value=0))
+        node.equations.append(connect_equation)
 
     # disconnected flow variables default to 0
     for sym in disconnected_flow_variables.values():
@@ -670,10 +1221,18 @@ def add_state_value_equations(node: ast.Node) -> None:
 def add_variable_value_statements(node: ast.Node) -> None:
     # we do this here, instead of in flatten_class, because symbol values
     # inside flattened classes may be modified later by modify_class().
+    # The bindings of outputs and protected variables are evaluated before
+    # the algorithm.
+    bindings = []
     for sym in node.symbols.values():
         if not (isinstance(sym.value, ast.Primary) and sym.value.value == None):
-            node.statements.append(ast.AssignmentStatement(left=[sym], right=sym.value))
+            statement = ast.AssignmentStatement(left=[sym], right=sym.value)
+            if 'input' in sym.prefixes:
+                node.statements.append(statement)
+            else:
+                bindings.append(statement)
             sym.value = ast.Primary(value=None)
+    node.statements[:0] = bindings
 
 
 class StateAnnotator(TreeListener):
@@ -709,6 +1268,493 @@ def annotate_states(root: ast.Collection, node: ast.Node) -> None:
     w.walk(StateAnnotator(root, node), node)
 
 
+class ConstantEvaluationError(Exception):
+    pass
+
+
+def modelica_div(a, b):
+    # Integer division, truncated towards zero
+    q = a / b
+    return math.floor(q) if q >= 0 else math.ceil(q)
+
+
+# Operators and built-in functions that structural parameters may use
+CONSTANT_OPERATORS = {
+    '+': lambda *args: args[0] if len(args) == 1 else functools.reduce(lambda a, b: a + b, args),
+    '-': lambda *args: -args[0] if len(args) == 1 else args[0] - args[1],
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '^': lambda a, b: a ** b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '!=': lambda a, b: a != b,
+    'and': lambda a, b: a and b,
+    'or': lambda a, b: a or b,
+    'not': lambda a: not a,
+    'abs': abs,
+    'min': min,
+    'max': max,
+    'sqrt': math.sqrt,
+    'div': modelica_div,
+    'mod': lambda a, b: a - math.floor(a / b) * b,
+    'rem': lambda a, b: a - modelica_div(a, b) * b,
+    'integer': math.floor,
+    'floor': math.floor,
+    'ceil': math.ceil,
+}
+
+
+class ConstantEvaluator(object):
+    """
+    Evaluates structural parameters, such as array sizes, loop ranges and
+    indices, directly on the tree of a flat class.  The values of the
+    symbols are memoized, so every parameter is evaluated only once.
+    """
+
+    def __init__(self, flat_class: ast.Class):
+        self.flat_class = flat_class
+        self.values = {}
+
+    def symbol_value(self, name: str):
+        """
+        :param name: name of a symbol of the flat class
+        :return: value of the symbol
+        """
+        if name not in self.values:
+            try:
+                sym = self.flat_class.symbols[name]
+            except KeyError:
+                raise ConstantEvaluationError('Unknown symbol {}'.format(name))
+            self.values[name] = ConstantEvaluationError('Value of {} depends on itself'.format(name))
+            try:
+                self.values[name] = self.evaluate(sym.value)
+            except ConstantEvaluationError:
+                del self.values[name]
+                raise
+        value = self.values[name]
+        if isinstance(value, ConstantEvaluationError):
+            raise value
+        return value
+
+    def evaluate(self, tree: Union[ast.Primary, ast.ComponentRef, ast.Expression, ast.IfExpression, ast.Array, ast.Slice],
+                 variables: dict = {}):
+        """
+        Evaluate an expression.
+        :param tree: expression to evaluate
+        :param variables: values of names that do not refer to symbols of the class, such as loop indices
+        :return: value, or array of values for arrays and slices
+        """
+        if isinstance(tree, ast.Primary):
+            if tree.value is None or isinstance(tree.value, str):
+                raise ConstantEvaluationError('{} is not a constant'.format(tree.value))
+            return tree.value
+        elif isinstance(tree, ast.ComponentRef):
+            if tree.child:
+                raise ConstantEvaluationError('Unresolved reference to {}'.format(tree))
+            if tree.name in variables:
+                value = variables[tree.name]
+            else:
+                value = self.symbol_value(tree.name)
+            for index in tree.indices:
+                # Modelica indexing starts from one;  Python from zero.
+                try:
+                    value = value[int(self.evaluate(index, variables)) - 1]
+                except (TypeError, IndexError):
+                    raise ConstantEvaluationError('Cannot index {}'.format(tree.name))
+            return value
+        elif isinstance(tree, ast.Expression):
+            op = tree.operator.name if isinstance(tree.operator, ast.ComponentRef) else tree.operator
+            if op.startswith('.'):
+                op = op[1:]
+            if op == 'size':
+                return self.size(tree, variables)
+            if op not in CONSTANT_OPERATORS:
+                raise ConstantEvaluationError('Cannot evaluate operator {}'.format(op))
+            operands = [self.evaluate(operand, variables) for operand in tree.operands]
+            try:
+                return CONSTANT_OPERATORS[op](*operands)
+            except TypeError:
+                raise ConstantEvaluationError('Cannot evaluate operator {} on {}'.format(op, operands))
+        elif isinstance(tree, ast.IfExpression):
+            for condition, expression in zip(tree.conditions, tree.expressions):
+                if self.evaluate(condition, variables):
+                    return self.evaluate(expression, variables)
+            return self.evaluate(tree.expressions[-1], variables)
+        elif isinstance(tree, ast.Array):
+            return np.array([self.evaluate(value, variables) for value in tree.values])
+        elif isinstance(tree, ast.Slice):
+            start = int(self.evaluate(tree.start, variables))
+            step = int(self.evaluate(tree.step, variables))
+            stop = int(self.evaluate(tree.stop, variables))
+            return np.arange(start, stop + step, step, dtype=np.int)
+        else:
+            raise ConstantEvaluationError('Unexpected node type {}'.format(tree.__class__.__name__))
+
+    def size(self, tree: ast.Expression, variables: dict):
+        operand = tree.operands[0]
+        if not isinstance(operand, ast.ComponentRef) or operand.indices or operand.name not in self.flat_class.symbols:
+            raise ConstantEvaluationError('Cannot determine the size of {}'.format(operand))
+        sizes = [int(self.evaluate(d, variables)) for d in self.flat_class.symbols[operand.name].dimensions]
+        if len(tree.operands) == 1:
+            return sizes
+        return sizes[int(self.evaluate(tree.operands[1], variables)) - 1]
+
+
+def constant_evaluator(flat_class: ast.Class) -> ConstantEvaluator:
+    """
+    :param flat_class: flattened class
+    :return: the constant evaluator of the class, shared by all its users
+    """
+    evaluator = getattr(flat_class, '_constant_evaluator', None)
+    if evaluator is None:
+        evaluator = ConstantEvaluator(flat_class)
+        flat_class._constant_evaluator = evaluator
+    return evaluator
+
+
+FlatElement = namedtuple('FlatElement', ['kind', 'name', 'node'])
+
+
+def iter_flatten(root: ast.Collection, component_ref: ast.ComponentRef,
+                 vectorize_arrays=False) -> Iterator[FlatElement]:
+    """
+    Flatten a class incrementally.  This is a generator that yields the
+    elements of the flattened model as soon as they are produced, so that a
+    backend can convert them one at a time, instead of waiting for the whole
+    model to be flattened.
+
+    The first element is the flat class, of kind 'class'.  For every
+    component, the functions it calls (kind 'function'), its symbols (kind
+    'symbol') and its equations (kinds 'equation' and 'initial_equation')
+    follow, in that order.  The equations that can only be formed once all
+    components are known, i.e., the expanded connect clauses, the equations
+    of the class itself and the equations for the symbol values, are yielded
+    last.
+
+    The flat class keeps the symbols, functions and statements of the model,
+    but not its equations.  The symbols are finalized in place: their
+    references are resolved, and the state prefix is added, by the time the
+    generator is exhausted.
+    :param root: The Collection to flatten
+    :param component_ref: The class that we want to create a flat model for
+    :param vectorize_arrays: vectorize the equations of arrays of component instances
+    :return: generator of the elements of the flattened model
+    """
+
+    # The within information is needed at the class level when extending
+    for f in root.files:
+        for c in f.classes.values():
+            c.within = f.within
+
+    orig_class = root.find_class(component_ref)
+    flat_class = ast.Class(
+        name=orig_class.name,
+        type=orig_class.type,
+    )
+    yield FlatElement('class', flat_class.name, flat_class)
+
+    w = TreeWalker()
+    annotator = StateAnnotator(root, flat_class)
+    yielded_functions = set()
+
+    def function_elements(functions):
+        for function_name, function in functions.items():
+            if function_name not in yielded_functions:
+                yielded_functions.add(function_name)
+                add_variable_value_statements(function)
+                yield FlatElement('function', function_name, function)
+
+    root._flat_functions = OrderedDict()
+    try:
+        extended_orig_class = extend_class(root, orig_class)
+
+        for component in flatten_components(root, orig_class, extended_orig_class, flat_class, '',
+                                            vectorize_arrays=vectorize_arrays, keep_equations=False,
+                                            in_place=True):
+            yield from function_elements(component.functions)
+            for sym in component.symbols:
+                # connector symbols are stripped when expanding the connect clauses
+                if not hasattr(sym, '__connector_type'):
+                    yield FlatElement('symbol', sym.name, sym)
+            for kind, equations in [('equation', component.equations),
+                                    ('initial_equation', component.initial_equations)]:
+                for equation in equations:
+                    if not isinstance(equation, ast.ConnectClause):
+                        w.walk(annotator, equation)
+                        yield FlatElement(kind, None, equation)
+
+        # expand connectors
+        expand_connectors(root, flat_class)
+    finally:
+        root._flat_functions = None
+
+    # add equations for state symbol values
+    add_state_value_equations(flat_class)
+
+    # annotate states
+    annotate_states(root, flat_class)
+
+    yield from function_elements(flat_class.functions)
+    for kind, equations in [('equation', flat_class.equations),
+                            ('initial_equation', flat_class.initial_equations)]:
+        for equation in equations:
+            yield FlatElement(kind, None, equation)
+    flat_class.equations = []
+    flat_class.initial_equations = []
+
+
+class NameTable(object):
+    """
+    Dense integer ids for the symbols of a flattened class.  Symbol i has
+    name names[i]; the names are interned, so that equal names share storage
+    and compare by identity.
+    """
+
+    def __init__(self, names):
+        self.names = [sys.intern(name) for name in names]  # type: List[str]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def id(self, name: str) -> int:
+        """
+        :param name: name of a symbol
+        :return: id of the symbol
+        """
+        return self.ids[name]
+
+    def name(self, id: int) -> str:
+        """
+        :param id: id of a symbol
+        :return: name of the symbol
+        """
+        return self.names[id]
+
+
+def assign_symbol_ids(node: ast.Class) -> NameTable:
+    """
+    Number the symbols of a flattened class in order of declaration.
+    :param node: flat class
+    :return: table of the names of the symbols, by id
+    """
+    names = NameTable(node.symbols.keys())
+    for i, sym in enumerate(node.symbols.values()):
+        sym.id = i
+    return names
+
+
+def intern_names(node: ast.Class) -> None:
+    """
+    Intern the names of the symbols of a flattened class, and of the
+    component references in it.
+    :param node: flat class
+    :return: None
+    """
+    node.symbols = OrderedDict((sys.intern(k), v) for k, v in node.symbols.items())
+    stack = [node]
+    while stack:
+        tree = stack.pop()
+        if isinstance(tree, (ast.Symbol, ast.ComponentRef)):
+            tree.name = sys.intern(tree.name)
+        if isinstance(tree, ast.Node):
+            stack.extend(tree.__dict__.values())
+        elif isinstance(tree, dict):
+            stack.extend(tree.values())
+        elif isinstance(tree, list):
+            stack.extend(tree)
+
+
+class Incidence(object):
+    """
+    Sparse equation-variable incidence matrix in compressed sparse row format.
+    The variables of equation i are symbols[indices[indptr[i]:indptr[i + 1]]].
+    Variables that occur both differentiated and undifferentiated in an
+    equation have two entries, distinguished by the derivative flags.
+    """
+
+    def __init__(self, symbols: list, indptr: np.ndarray, indices: np.ndarray, derivative: np.ndarray):
+        self.symbols = symbols
+        self.indptr = indptr
+        self.indices = indices
+        self.derivative = derivative
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def variables(self, equation: int, derivative: bool = None) -> list:
+        """
+        :param equation: index of the equation
+        :param derivative: if not None, only return variables that do (or do not) occur differentiated
+        :return: names of the variables in the equation
+        """
+        start, stop = self.indptr[equation], self.indptr[equation + 1]
+        return [self.symbols[i] for i, d in zip(self.indices[start:stop], self.derivative[start:stop])
+                if derivative is None or d == derivative]
+
+
+class IncidenceBuilder(TreeListener):
+    """
+    Collects the symbols referenced by an equation, and whether they are
+    referenced inside a der() operator.
+    """
+
+    def __init__(self, symbol_indices: dict):
+        self.symbol_indices = symbol_indices
+        self.entries = set()
+        self.der_depth = 0
+        self.symbol_depth = 0
+        self.child_refs = set()
+        super().__init__()
+
+    def enterExpression(self, tree: ast.Expression):
+        if tree.operator == 'der':
+            self.der_depth += 1
+
+    def exitExpression(self, tree: ast.Expression):
+        if tree.operator == 'der':
+            self.der_depth -= 1
+
+    def enterSymbol(self, tree: ast.Symbol):
+        # The equations for the values of symbols refer to the symbol itself,
+        # and not to the symbols in its attributes.
+        self.symbol_depth += 1
+        if self.symbol_depth == 1:
+            i = self.symbol_indices.get(tree.name, None)
+            if i is not None:
+                self.entries.add((i, self.der_depth > 0))
+
+    def exitSymbol(self, tree: ast.Symbol):
+        self.symbol_depth -= 1
+
+    def enterComponentRef(self, tree: ast.ComponentRef):
+        # Children are part of the name of their parent
+        if tree in self.child_refs or self.symbol_depth > 0:
+            return
+        if tree.child:
+            self.child_refs.add(tree.child[0])
+            name = str(tree)
+        else:
+            name = tree.name
+
+        i = self.symbol_indices.get(name, None)
+        if i is not None:
+            self.entries.add((i, self.der_depth > 0))
+
+
+def build_incidence(names: NameTable, equations: list) -> Incidence:
+    """
+    Determine which symbols each equation refers to.
+    :param names: name table of the symbols of the flat class
+    :param equations: list of equations of the class
+    :return: the incidence of the equations, with variables identified by their symbol ids
+    """
+    indptr = [0]
+    indices = []
+    derivative = []
+
+    w = TreeWalker()
+    for equation in equations:
+        builder = IncidenceBuilder(names.ids)
+        w.walk(builder, equation)
+        for i, d in sorted(builder.entries):
+            indices.append(i)
+            derivative.append(d)
+        indptr.append(len(indices))
+
+    return Incidence(names.names, np.array(indptr, dtype=int), np.array(indices, dtype=int), np.array(derivative, dtype=bool))
+
+
+PrunedElements = namedtuple('PrunedElements', ['symbols', 'functions'])
+
+
+class ReferenceCollector(IncidenceBuilder):
+    """
+    Collects the symbols and functions referenced by a tree.
+    """
+
+    def __init__(self, symbol_indices: dict, functions: dict):
+        self.functions = functions
+        self.function_refs = set()
+        super().__init__(symbol_indices)
+
+    def enterExpression(self, tree: ast.Expression):
+        super().enterExpression(tree)
+        if isinstance(tree.operator, str) and tree.operator in self.functions:
+            self.function_refs.add(tree.operator)
+
+
+def eliminate_dead_elements(flat_file: ast.File, class_name: str) -> PrunedElements:
+    """
+    Remove the parameters, constants and protected variables of a flattened
+    class that none of its equations, statements or remaining variables refer
+    to, as well as the functions that are not called.
+    :param flat_file: file containing the flattened class and its functions
+    :param class_name: name of the flattened class
+    :return: the names of the removed symbols and functions
+    """
+    flat_class = flat_file.classes[class_name]
+    functions = OrderedDict((k, c) for k, c in flat_file.classes.items() if c.type == 'function')
+
+    symbols = NameTable(flat_class.symbols.keys())
+
+    def removable(sym):
+        return 'parameter' in sym.prefixes or 'constant' in sym.prefixes or \
+            sym.visibility == ast.Visibility.PROTECTED
+
+    w = TreeWalker()
+    collector = ReferenceCollector(symbols.ids, functions)
+    w.handle_walk(collector, [flat_class.equations, flat_class.initial_equations,
+                              flat_class.statements, flat_class.initial_statements])
+
+    # Propagate through the dimensions and attributes of live symbols
+    live_symbols = set()
+    symbol_stack = [i for i, name in enumerate(symbols.names) if not removable(flat_class.symbols[name])]
+    symbol_stack += [i for i, d in collector.entries]
+    while symbol_stack:
+        i = symbol_stack.pop()
+        if i in live_symbols:
+            continue
+        live_symbols.add(i)
+        sym = flat_class.symbols[symbols.name(i)]
+        collector.entries = set()
+        w.handle_walk(collector, [sym.dimensions] + [getattr(sym, a) for a in ast.Symbol.ATTRIBUTES])
+        symbol_stack += [j for j, d in collector.entries]
+
+    # Propagate through function calls
+    live_functions = set()
+    function_stack = list(collector.function_refs)
+    while function_stack:
+        f = function_stack.pop()
+        if f in live_functions:
+            continue
+        live_functions.add(f)
+        function_collector = ReferenceCollector({}, functions)
+        w.walk(function_collector, functions[f])
+        function_stack += list(function_collector.function_refs)
+
+    pruned = PrunedElements([name for i, name in enumerate(symbols.names) if i not in live_symbols],
+                            [f for f in functions.keys() if f not in live_functions])
+    for name in pruned.symbols:
+        del flat_class.symbols[name]
+    for f in pruned.functions:
+        del flat_file.classes[f]
+
+    logger.info("Eliminated {} symbols and {} functions from {}".format(
+        len(pruned.symbols), len(pruned.functions), class_name))
+    logger.debug("Eliminated symbols: {}".format(', '.join(pruned.symbols)))
+    logger.debug("Eliminated functions: {}".format(', '.join(pruned.functions)))
+
+    return pruned
+
+
 class FunctionExpander(TreeListener):
     """
     Listener to extract functions
@@ -754,13 +1800,237 @@ def fully_scope_function_calls(root: ast.Collection, within: list, expression: a
     return expression_copy
 
 
-def flatten(root: ast.Collection, component_ref: ast.ComponentRef) -> ast.File:
+def class_closure_hash(root: ast.Collection, classes: set, digests: dict = None) -> str:
+    """
+    Hash the definitions of a set of classes.
+    :param root: collection for performing class lookup
+    :param classes: set of fully scoped class name tuples
+    :param digests: hashes of the definitions of individual classes, which are added to as needed
+    :return: hex digest, or None if any of the classes does not exist
+    """
+    if digests is None:
+        digests = {}
+    h = hashlib.sha1()
+    for class_tuple in sorted(classes):
+        if class_tuple not in digests:
+            try:
+                c = root.find_class(ast.ComponentRef.from_tuple(class_tuple))
+            except (KeyError, ast.ClassNotFoundError):
+                return None
+            digests[class_tuple] = hashlib.sha1(repr(c).encode('utf-8')).hexdigest()
+        h.update(CLASS_SEPARATOR.join(class_tuple).encode('utf-8'))
+        h.update(digests[class_tuple].encode('utf-8'))
+    return h.hexdigest()
+
+
+def load_flat_file(root: ast.Collection, component_ref: ast.ComponentRef, cache_folder: str,
+                   options: dict) -> ast.File:
+    """
+    Load a flattened model from the cache.  The cached model is valid as long as
+    none of the classes it was flattened from has changed.
+    :param root: collection that the model is to be flattened from
+    :param component_ref: the class to flatten
+    :param cache_folder: folder containing the cache
+    :param options: options that the model is to be flattened with
+    :return: the flattened model, or None if not in the cache or out of date
+    """
+    cache_file = os.path.join(cache_folder, str(component_ref) + '.flat')
+    try:
+        with open(cache_file, 'rb') as f:
+            db = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+
+    if db['version'] != __version__ or db['options'] != options:
+        return None
+
+    if db['closure_hash'] != class_closure_hash(root, db['classes']):
+        return None
+
+    logger.info("Loaded flattened model {} from cache".format(component_ref))
+
+    flat_file = db['flat_file']
+    flat_file._dependency_graph = DependencyGraph()
+    flat_file._dependency_graph.classes = db['classes']
+
+    # Names are not interned when unpickled, so we intern them again and
+    # rebuild the name table.  The model class follows its functions.
+    flat_class = list(flat_file.classes.values())[-1]
+    intern_names(flat_class)
+    flat_file._names = assign_symbol_ids(flat_class)
+    flat_file._incidence.symbols = flat_file.names.names
+    flat_file._initial_incidence.symbols = flat_file.names.names
+    return flat_file
+
+
+def save_flat_file(root: ast.Collection, component_ref: ast.ComponentRef, cache_folder: str, flat_file: ast.File,
+                   options: dict) -> None:
+    """
+    Store a flattened model in the cache, along with the hash of the
+    classes it was flattened from.
+    :param root: collection that the model was flattened from
+    :param component_ref: the flattened class
+    :param cache_folder: folder containing the cache
+    :param flat_file: the flattened model
+    :param options: options that the model was flattened with
+    :return: None
+    """
+    classes = flat_file.dependency_graph.classes
+
+    db = {}
+    db['version'] = __version__
+    db['options'] = options
+    db['classes'] = classes
+    db['closure_hash'] = class_closure_hash(root, classes)
+    db['flat_file'] = ast.File(within=flat_file.within, classes=flat_file.classes)
+    db['flat_file']._incidence = flat_file.incidence
+    db['flat_file']._initial_incidence = flat_file.initial_incidence
+    db['flat_file']._pruned = flat_file.pruned
+
+    cache_file = os.path.join(cache_folder, str(component_ref) + '.flat')
+    with open(cache_file, 'wb') as f:
+        pickle.dump(db, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ClassReferenceCollector(TreeListener):
+    """
+    Collects the full names of all component references in a tree.  Some of
+    these refer to classes, e.g., types, extended classes and functions.
+    """
+
+    def __init__(self):
+        self.refs = set()
+        self.child_refs = set()
+        super().__init__()
+
+    def enterComponentRef(self, tree: ast.ComponentRef):
+        # Children are part of the name of their parent
+        if tree in self.child_refs:
+            return
+        if tree.child:
+            self.child_refs.add(tree.child[0])
+        self.refs.add(tree.to_tuple())
+
+
+def prune_collection(root: ast.Collection, component_ref: ast.ComponentRef) -> ast.Collection:
+    """
+    Find the classes that a class refers to, directly or indirectly, through
+    the types of its components, extends clauses, function calls and short
+    class definitions.
+    :param root: collection containing the class
+    :param component_ref: the class
+    :return: collection containing only the referenced classes
+    """
+    lookups = {}
+
+    def find_class_tuple(ref_tuple, within_tuple):
+        key = (ref_tuple, within_tuple)
+        if key not in lookups:
+            within = [ast.ComponentRef.from_tuple(within_tuple)] if within_tuple else None
+            try:
+                c, ref = root.find_class(ast.ComponentRef.from_tuple(ref_tuple), within, return_ref=True)
+                lookups[key] = ref.to_tuple()
+            except (KeyError, ast.ClassNotFoundError):
+                lookups[key] = None
+        return lookups[key]
+
+    reached = set()
+    stack = [(root.find_class(component_ref), component_ref.to_tuple())]
+    while stack:
+        c, class_tuple = stack.pop()
+        if class_tuple in reached:
+            continue
+        reached.add(class_tuple)
+
+        # Nested classes may be referred to by their local names.  Packages
+        # are containers, of which we only keep the referenced classes.
+        if c.type != 'package':
+            stack.extend((nested_c, class_tuple + (name,)) for name, nested_c in c.classes.items())
+
+        collector = ClassReferenceCollector()
+        w = TreeWalker()
+        for key, value in c.__dict__.items():
+            if key != 'classes':
+                w.handle_walk(collector, value)
+
+        # References such as 'P.c' to a constant of package P resolve to the package
+        for ref_tuple in collector.refs:
+            for n in range(len(ref_tuple), 0, -1):
+                found_tuple = find_class_tuple(ref_tuple[:n], class_tuple[:-1])
+                if found_tuple is not None:
+                    stack.append((root.find_class(ast.ComponentRef.from_tuple(found_tuple)), found_tuple))
+                    break
+
+    def prune_class(c, class_tuple):
+        if class_tuple in reached and c.type != 'package':
+            return c
+        classes = OrderedDict()
+        for name, nested_c in c.classes.items():
+            pruned_c = prune_class(nested_c, class_tuple + (name,))
+            if pruned_c is not None:
+                classes[name] = pruned_c
+        if class_tuple not in reached and not classes:
+            return None
+        pruned_c = copy.copy(c)
+        pruned_c.classes = classes
+        return pruned_c
+
+    pruned_root = ast.Collection()
+    for f in root.files:
+        within_tuple = f.within[0].to_tuple() if f.within else tuple()
+        classes = OrderedDict()
+        for name, c in f.classes.items():
+            pruned_c = prune_class(c, within_tuple + (name,))
+            if pruned_c is not None:
+                classes[name] = pruned_c
+        if classes:
+            pruned_root.files.append(ast.File(within=f.within, classes=classes))
+
+    logger.debug("Pruned collection to {} classes for {}".format(len(reached), component_ref))
+
+    return pruned_root
+
+
+def flatten(root: ast.Collection, component_ref: ast.ComponentRef,
+            previous: ast.File = None, changed_classes: list = None, cache_folder: str = None,
+            vectorize_arrays=False, profiler: FlatteningProfiler = None, prune_dead_elements=False,
+            incremental=False) -> ast.File:
     """
     This function takes a Collection and flattens it so that all subclasses instances
     are replaced by the their equations and symbols with name mangling
     of the instance name passed.
+
+    With incremental, the dependencies of every component instance on the
+    source classes are recorded in the dependency graph of the returned file,
+    along with a copy of the flattened instance.  When a file flattened this
+    way and the classes that changed since are passed, only the instances
+    affected by the changes are flattened again.  Incremental flattening
+    implies recording the instances again.
+
+    If a cache folder is given, the flattened model is stored there, and
+    reused for as long as none of the classes it depends on change.
+
+    With vectorize_arrays, the equations of a one-dimensional array of
+    component instances are kept as a single for equation looping over the
+    instances, instead of being emitted once for the whole array.  Backends
+    can then generate a single template for all instances.
+
+    If a profiler is given, the cost of flattening is recorded in it per
+    source class.
+
+    With prune_dead_elements, the parameters, constants, protected variables
+    and functions that the model does not refer to are removed from the
+    flattened model.  Their names are available from the pruned property of
+    the returned file.
     :param root: The Collection to flatten
     :param class_name: The class that we want to create a flat model for
+    :param previous: a File previously returned by flatten
+    :param changed_classes: fully scoped names of the classes that changed since previous was flattened
+    :param cache_folder: folder in which to cache the flattened model
+    :param vectorize_arrays: vectorize the equations of arrays of component instances
+    :param profiler: profiler in which to record the cost of flattening
+    :param prune_dead_elements: remove unreferenced elements from the flattened model
+    :param incremental: record the component instances, so that they can be reused by a later flatten
     :return: flat_file, a File containing the flattened class
     """
 
@@ -769,11 +2039,39 @@ def flatten(root: ast.Collection, component_ref: ast.ComponentRef) -> ast.File:
         for c in f.classes.values():
             c.within = f.within
 
-    # flatten class
-    flat_class = flatten_class(root, root.find_class(component_ref), '')
-
-    # expand connectors
-    expand_connectors(root, flat_class)
+    # options that change the flattened model
+    options = {'vectorize_arrays': vectorize_arrays, 'prune_dead_elements': prune_dead_elements}
+
+    if cache_folder is not None:
+        flat_file = load_flat_file(root, component_ref, cache_folder, options)
+        if flat_file is not None:
+            return flat_file
+
+    # The classes the model depends on are only recorded for the cache, and
+    # the component instances only for incremental flattening.
+    incremental = incremental or previous is not None or changed_classes is not None
+    if incremental or cache_folder is not None:
+        dependency_graph = DependencyGraph(previous.dependency_graph if previous is not None else None,
+                                           changed_classes, vectorize_arrays)
+        root._lookup_logs = [dependency_graph.classes]
+    else:
+        dependency_graph = None
+        root._lookup_logs = []
+
+    root._profiler = profiler
+    root._flat_functions = OrderedDict()
+    try:
+        # flatten class
+        flat_class = flatten_class(root, root.find_class(component_ref), '',
+                                   dependency_graph=dependency_graph if incremental else None,
+                                   vectorize_arrays=vectorize_arrays)
+
+        # expand connectors
+        expand_connectors(root, flat_class)
+    finally:
+        root._lookup_logs = []
+        root._profiler = None
+        root._flat_functions = None
 
     # add equations for state symbol values
     add_state_value_equations(flat_class)
@@ -795,4 +2093,23 @@ def flatten(root: ast.Collection, component_ref: ast.ComponentRef) -> ast.File:
     flat_file.classes = functions_and_classes
     flat_class.functions = OrderedDict()
 
+    # remove unreferenced elements
+    if prune_dead_elements:
+        flat_file._pruned = eliminate_dead_elements(flat_file, flat_class.name)
+
+    # symbol ids
+    flat_file._names = assign_symbol_ids(flat_class)
+
+    # equation-variable incidence
+    flat_file._incidence = build_incidence(flat_file.names, flat_class.equations)
+    flat_file._initial_incidence = build_incidence(flat_file.names, flat_class.initial_equations)
+
+    # Do not keep the previous flattening alive
+    if dependency_graph is not None:
+        dependency_graph._previous = {}
+    flat_file._dependency_graph = dependency_graph
+
+    if cache_folder is not None:
+        save_flat_file(root, component_ref, cache_folder, flat_file, options)
+
     return flat_file
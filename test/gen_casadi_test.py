@@ -15,7 +15,7 @@ import numpy as np
 import pymola.backends.casadi.generator as gen_casadi
 from pymola.backends.casadi.model import Model, Variable
 from pymola.backends.casadi.api import transfer_model, CachedModel
-from pymola import parser, ast
+from pymola import parser, tree, ast
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -203,6 +203,29 @@ class GenCasadiTest(unittest.TestCase):
 
         self.assert_model_equivalent_numeric(ref_model, casadi_model)
 
+    def test_connector_junction(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        casadi_model = gen_casadi.generate(ast_tree, 'Junction')
+        ref_model = Model()
+        print(casadi_model)
+
+        names = ['a', 'b', 'c', 'd']
+        up_H = [ca.MX.sym(n + '.up.H') for n in names]
+        up_Q = [ca.MX.sym(n + '.up.Q') for n in names]
+        down_H = [ca.MX.sym(n + '.down.H') for n in names]
+        down_Q = [ca.MX.sym(n + '.down.Q') for n in names]
+
+        ref_model.alg_states = list(map(Variable, up_H + down_H + up_Q + down_Q))
+
+        ref_model.equations = [u - d for u, d in zip(up_H, down_H)] + \
+                              [down_H[i] - up_H[1] for i in [0, 2, 3]] + \
+                              [u + d for u, d in zip(up_Q, down_Q)] + \
+                              [down_Q[0] + up_Q[1] + down_Q[2] + down_Q[3]]
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
     def test_connector_hqz(self):
         with open(os.path.join(TEST_DIR, 'ConnectorHQZ.mo'), 'r') as f:
             txt = f.read()
@@ -473,6 +496,59 @@ class GenCasadiTest(unittest.TestCase):
 
         self.assert_model_equivalent_numeric(ref_model, casadi_model)
 
+    def test_function_cache(self):
+        with open(os.path.join(TEST_DIR, 'FunctionCall.mo'), 'r') as f:
+            txt = f.read()
+        gen_casadi.FUNCTION_CACHE.clear()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'FunctionCall')
+        self.assertEqual([k[0] for k in gen_casadi.FUNCTION_CACHE.keys()], ['CircleProperties'])
+        function = gen_casadi.FUNCTION_CACHE[next(iter(gen_casadi.FUNCTION_CACHE.keys()))]
+
+        # Generating the model again reuses the converted function
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'FunctionCall')
+        self.assertEqual(len(gen_casadi.FUNCTION_CACHE), 1)
+        self.assertIs(gen_casadi.FUNCTION_CACHE[next(iter(gen_casadi.FUNCTION_CACHE.keys()))], function)
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # The least recently used functions are dropped
+        size = gen_casadi.FUNCTION_CACHE_SIZE
+        try:
+            gen_casadi.FUNCTION_CACHE_SIZE = 1
+            gen_casadi.generate(parser.parse(txt.replace('CircleProperties', 'CircleProperties2')), 'FunctionCall')
+            self.assertEqual([k[0] for k in gen_casadi.FUNCTION_CACHE.keys()], ['CircleProperties2'])
+        finally:
+            gen_casadi.FUNCTION_CACHE_SIZE = size
+
+        # Changing a called function invalidates the functions calling it
+        with open(os.path.join(TEST_DIR, 'FunctionShared.mo'), 'r') as f:
+            txt = f.read()
+        gen_casadi.generate(parser.parse(txt), 'Points')
+        txt = txt.replace('y := x * x;', 'y := 2 * x * x;')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'Points')
+        gen_casadi.FUNCTION_CACHE.clear()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'Points')
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+    def test_registered_function(self):
+        with open(os.path.join(TEST_DIR, 'FunctionShared.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'Points')
+
+        # Calls to a registered function replace the body of the Modelica function
+        x = ca.MX.sym('x')
+        y = ca.MX.sym('y')
+        norm = ca.Function('norm_external', [x, y], [ca.sqrt(x ** 2 + y ** 2)])
+        gen_casadi.register_function('SharedFunctions.norm', norm)
+        try:
+            casadi_model = gen_casadi.generate(parser.parse(txt), 'Points')
+        finally:
+            del gen_casadi.OPERATORS['SharedFunctions.norm', None]
+        print(casadi_model)
+
+        self.assertIn('norm_external', str(casadi_model.equations[0]))
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
     def test_forloop(self):
         with open(os.path.join(TEST_DIR, 'ForLoop.mo'), 'r') as f:
             txt = f.read()
@@ -498,6 +574,256 @@ class GenCasadiTest(unittest.TestCase):
 
         self.assert_model_equivalent_numeric(ref_model, casadi_model)
 
+    def test_nested_forloop(self):
+        with open(os.path.join(TEST_DIR, 'NestedForLoop.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        casadi_model = gen_casadi.generate(ast_tree, 'NestedForLoop')
+        print(casadi_model)
+        ref_model = Model()
+
+        x = ca.MX.sym("x", 10, 20)
+        n = ca.MX.sym("n")
+        m = ca.MX.sym("m")
+
+        ref_model.alg_states = list(map(Variable, [x]))
+        ref_model.parameters = list(map(Variable, [n, m]))
+        ref_model.parameters[0].value = 10
+        ref_model.parameters[1].value = 20
+        ref_model.equations = [x - np.add.outer(np.arange(1, 11), np.arange(1, 21))]
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # The loops are mapped as a whole, rather than unrolled
+        self.assertEqual(len(casadi_model.equations), 1)
+
+    def test_forloop_instances(self):
+        with open(os.path.join(TEST_DIR, 'ForLoopInstances.mo'), 'r') as f:
+            txt = f.read()
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoopInstances')
+        print(casadi_model)
+        ref_model = Model()
+
+        x = [ca.MX.sym('a.x', 3), ca.MX.sym('b.x', 3), ca.MX.sym('c.x', 4)]
+        der_x = [ca.MX.sym('der(a.x)', 3), ca.MX.sym('der(b.x)', 3), ca.MX.sym('der(c.x)', 4)]
+        n = [ca.MX.sym('a.n'), ca.MX.sym('b.n'), ca.MX.sym('c.n')]
+
+        ref_model.states = list(map(Variable, x))
+        ref_model.der_states = list(map(Variable, der_x))
+        ref_model.parameters = list(map(Variable, n))
+        for p, v in zip(ref_model.parameters, [3, 3, 4]):
+            p.value = v
+        ref_model.equations = [d + np.arange(1, d.numel() + 1) * s for s, d in zip(x, der_x)]
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # The loops of the instances share their loop body, and the loops
+        # with the same number of iterations share the mapped function
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='ForLoopInstances'))
+        casadi_gen = gen_casadi.Generator(flat_tree, 'ForLoopInstances', {})
+        tree.TreeWalker().walk(casadi_gen, flat_tree)
+        self.assertEqual(len(casadi_gen.loop_bodies), 1)
+        self.assertEqual(len(casadi_gen.mapped_functions), 2)
+
+        # Loops with the same syntax share their body only if the constant
+        # indices in their bodies are the same as well
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoopInstancesConstantIndex')
+        ref_model = Model()
+
+        x = [ca.MX.sym('a.x', 3), ca.MX.sym('b.x', 3), ca.MX.sym('c.x', 3)]
+        der_x = [ca.MX.sym('der(a.x)', 3), ca.MX.sym('der(b.x)', 3), ca.MX.sym('der(c.x)', 3)]
+        k = [ca.MX.sym('a.k'), ca.MX.sym('b.k'), ca.MX.sym('c.k')]
+
+        ref_model.states = list(map(Variable, x))
+        ref_model.der_states = list(map(Variable, der_x))
+        ref_model.parameters = list(map(Variable, k))
+        for p, v in zip(ref_model.parameters, [1, 2, 2]):
+            p.value = v
+        ref_model.equations = [d - (s[v - 1] - s) for s, d, v in zip(x, der_x, [1, 2, 2])]
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='ForLoopInstancesConstantIndex'))
+        casadi_gen = gen_casadi.Generator(flat_tree, 'ForLoopInstancesConstantIndex', {})
+        tree.TreeWalker().walk(casadi_gen, flat_tree)
+        self.assertEqual(len(casadi_gen.loop_bodies), 2)
+
+    def test_forloop_map_mode(self):
+        with open(os.path.join(TEST_DIR, 'ForLoop.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'ForLoop')
+
+        def uses_openmp(model):
+            cg = ca.CodeGenerator('ForLoop')
+            cg.add(model.dae_residual_function)
+            return 'pragma omp' in cg.dump()
+
+        self.assertFalse(uses_openmp(ref_model))
+
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoop', {'map_mode': 'openmp'})
+        self.assertTrue(uses_openmp(casadi_model))
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # Small loops, and loops with a mode of their own, can be kept serial
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoop', {'map_mode': 'openmp', 'map_threshold': 20})
+        self.assertFalse(uses_openmp(casadi_model))
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoop', {'map_modes': {'i': 'openmp'}})
+        self.assertTrue(uses_openmp(casadi_model))
+        casadi_model = gen_casadi.generate(
+            parser.parse(txt), 'ForLoop', {'map_mode': 'openmp', 'map_modes': {'i': 'serial', 'j': 'serial', 'k': 'serial'}})
+        self.assertFalse(uses_openmp(casadi_model))
+
+    def test_forstatement_map_mode(self):
+        with open(os.path.join(TEST_DIR, 'ForStatement.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'ForStatement')
+
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='ForStatement'))
+        casadi_gen = gen_casadi.Generator(flat_tree, 'ForStatement', {})
+        tree.TreeWalker().walk(casadi_gen, flat_tree)
+        function = casadi_gen.get_function('LoopFunction')
+        self.assertEqual([float(v) for v in function(2.0)], [8.0, 20.0])
+
+        # The nested loop has independent iterations, and is mapped.  The
+        # sum carries its value from one iteration to the next, and is not.
+        calls = [function.instruction_MX(k).which_function() for k in range(function.n_instructions())
+                 if function.instruction_id(k) == ca.OP_CALL]
+        self.assertEqual(sum(1 for call in calls if call.name() == 'map'), 1)
+        self.assertEqual(sum(1 for call in calls if call.name() == 'loop_body_i'), 4)
+
+        cg = ca.CodeGenerator('ForStatement')
+        cg.add(function)
+        self.assertNotIn('pragma omp', cg.dump())
+
+        casadi_gen = gen_casadi.Generator(flat_tree, 'ForStatement', {'map_mode': 'openmp'})
+        tree.TreeWalker().walk(casadi_gen, flat_tree)
+        function = casadi_gen.get_function('LoopFunction')
+        cg = ca.CodeGenerator('ForStatement')
+        cg.add(function)
+        self.assertIn('pragma omp', cg.dump())
+        self.assertEqual([float(v) for v in function(2.0)], [8.0, 20.0])
+
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForStatement', {'map_mode': 'openmp'})
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+    def test_vectorized_component_array(self):
+        with open(os.path.join(TEST_DIR, 'ComponentArray.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        casadi_model = gen_casadi.generate(ast_tree, 'ComponentArray', {'vectorize_arrays': True})
+        print(casadi_model)
+        ref_model = Model()
+
+        x = ca.MX.sym("tanks.x", 3)
+        der_x = ca.MX.sym("der(tanks.x)", 3)
+        q = ca.MX.sym("tanks.q", 3)
+        k = ca.MX.sym("tanks.k", 3)
+        n = ca.MX.sym("n")
+
+        ref_model.states = list(map(Variable, [x]))
+        ref_model.der_states = list(map(Variable, [der_x]))
+        ref_model.alg_states = list(map(Variable, [q]))
+        ref_model.parameters = list(map(Variable, [k, n]))
+        ref_model.parameters[0].value = [1.0, 2.0, 3.0]
+        ref_model.parameters[1].value = 3
+        ref_model.equations = [ca.horzcat(der_x - (-k * x * q), q - x ** 2)]
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # The equations of the instances are kept as a single for loop over
+        # the array, rather than copied for every instance
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='ComponentArray'), vectorize_arrays=True)
+        flat_class = flat_tree.classes['ComponentArray']
+        self.assertEqual(list(flat_class.symbols.keys()), ['n', 'tanks.k', 'tanks.x', 'tanks.q'])
+        self.assertEqual(len(flat_class.equations), 1)
+        self.assertIsInstance(flat_class.equations[0], ast.ForEquation)
+        self.assertEqual(len(flat_class.equations[0].equations), 2)
+
+        # The loop is mapped as a whole
+        self.assertEqual(len(casadi_model.equations), 1)
+        self.assertTrue(casadi_model.equations[0].dep(0).dep(0).is_call())
+
+    def test_streaming(self):
+        with open(os.path.join(TEST_DIR, 'SpringSystem.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'SpringSystem')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'SpringSystem', {'streaming': True})
+        print(casadi_model)
+
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # Dimensions referring to components that are flattened later
+        with open(os.path.join(TEST_DIR, 'ForLoopInstances.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'ForLoopInstancesForward')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'ForLoopInstancesForward', {'streaming': True})
+        self.assertEqual([str(v) for v in casadi_model.states], [str(v) for v in ref_model.states])
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # Common subexpression elimination applies to the streamed equations
+        with open(os.path.join(TEST_DIR, 'Quad.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'Quad', {'streaming': True})
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'Quad', {'streaming': True, 'cse': True})
+        self.assertLess(casadi_model.dae_residual_function.n_nodes(), ref_model.dae_residual_function.n_nodes())
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        with self.assertRaises(ValueError):
+            gen_casadi.generate(parser.parse(txt), 'Quad', {'streaming': True, 'instance_functions': True})
+
+    def test_cse(self):
+        with open(os.path.join(TEST_DIR, 'Quad.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'Quad')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'Quad', {'cse': True})
+        print(casadi_model)
+
+        # Repeated terms, such as sin(phi) and tan(theta), are shared
+        self.assertLess(casadi_model.dae_residual_function.n_nodes(), ref_model.dae_residual_function.n_nodes())
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+    def test_instance_functions(self):
+        with open(os.path.join(TEST_DIR, 'FunctionShared.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'Points')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'Points', {'instance_functions': True})
+        print(casadi_model)
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # The equations of the three points are taken from a single call
+        calls = [e.dep(0).dep(0) for e in casadi_model.equations]
+        self.assertEqual(len(calls), 3)
+        for call in calls:
+            self.assertTrue(call.is_call())
+            self.assertTrue(ca.is_equal(call, calls[0]))
+
+        # Instances with delayed variables keep their own equations
+        ref_model = gen_casadi.generate(parser.parse(txt), 'DelayedPoints')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'DelayedPoints', {'instance_functions': True})
+        self.assertEqual(len(casadi_model.delayed_states), 2)
+        self.assertEqual([str(e) for e in casadi_model.equations], [str(e) for e in ref_model.equations])
+
+    def test_release_expressions(self):
+        with open(os.path.join(TEST_DIR, 'FunctionCall.mo'), 'r') as f:
+            txt = f.read()
+        ref_model = gen_casadi.generate(parser.parse(txt), 'FunctionCall')
+        casadi_model = gen_casadi.generate(parser.parse(txt), 'FunctionCall', {'release_expressions': True})
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
+        # Only the conversions of the equations themselves, and of symbols, are kept
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='FunctionCall'))
+        casadi_gen = gen_casadi.Generator(flat_tree, 'FunctionCall', {'release_expressions': True})
+        tree.TreeWalker().walk(casadi_gen, flat_tree)
+
+        flat_class = flat_tree.classes['FunctionCall']
+        for equation in flat_class.equations:
+            self.assertIn(equation, casadi_gen.src)
+            self.assertNotIn(equation.right, casadi_gen.src)
+        for statement in flat_tree.classes['CircleProperties'].statements:
+            self.assertNotIn(statement, casadi_gen.src)
+        for symbol in flat_class.symbols.values():
+            self.assertIn(symbol, casadi_gen.src)
+
     def test_arrayexpressions(self):
         with open(os.path.join(TEST_DIR, 'ArrayExpressions.mo'), 'r') as f:
             txt = f.read()
@@ -659,6 +985,11 @@ class GenCasadiTest(unittest.TestCase):
         # Compare
         self.assert_model_equivalent_numeric(ref_model, cached_model)
 
+        # The cache is not used with different compiler options
+        casadi_model = transfer_model(TEST_DIR, 'Aircraft', {'cache': True, 'cse': True})
+        self.assertNotIsInstance(casadi_model, CachedModel)
+        self.assert_model_equivalent_numeric(ref_model, casadi_model)
+
     def test_simplify_replace_constant_values(self):
         # Create model, cache it, and load the cache
         compiler_options = \
@@ -1218,6 +1549,74 @@ class GenCasadiTest(unittest.TestCase):
         # Compare
         self.assert_model_equivalent_numeric(casadi_model, ref_model)
 
+    def test_simplify_expand_sx(self):
+        # The simplifications give the same functions when expanded into SX
+        for compiler_options in [{},
+                                 {'expand_vectors': True},
+                                 {'replace_parameter_values': True, 'replace_parameter_expressions': True},
+                                 {'detect_aliases': True},
+                                 {'reduce_affine_expression': True},
+                                 {'expand_vectors': True,
+                                  'replace_constant_values': True,
+                                  'replace_constant_expressions': True,
+                                  'replace_parameter_values': True,
+                                  'replace_parameter_expressions': True,
+                                  'eliminate_constant_assignments': True,
+                                  'detect_aliases': True,
+                                  'eliminable_variable_expression': r'_\w+',
+                                  'reduce_affine_expression': True}]:
+            ref_model = transfer_model(TEST_DIR, 'Simplify', compiler_options)
+            casadi_model = transfer_model(TEST_DIR, 'Simplify', dict(compiler_options, expand_sx=True))
+
+            for f_name in ['dae_residual', 'initial_residual', 'variable_metadata']:
+                this = getattr(ref_model, f_name + '_function')
+                that = getattr(casadi_model, f_name + '_function')
+                if that.n_out() > 0:
+                    self.assertTrue(that.is_a('SXFunction'))
+
+                np.random.seed(0)
+                args_in = [ca.DM(this.sparsity_in(i), np.random.random(this.nnz_in(i))) for i in range(this.n_in())]
+                for this_out, that_out in zip(this.call(args_in), that.call(args_in)):
+                    this_out = ca.DM(this_out).full()
+                    that_out = ca.DM(that_out).full()
+                    np.testing.assert_allclose(this_out[~np.isnan(this_out)], that_out[~np.isnan(that_out)])
+
+    def test_expand_sx_fallback(self):
+        x = ca.MX.sym('x')
+        y = ca.MX.sym('y', 2)
+        A = ca.vertcat(ca.horzcat(x + 2, 1), ca.horzcat(1, 2))
+        solution = ca.solve(A, ca.DM([1, 1]), 'lapackqr')
+        try:
+            ca.Function('solution', [x], [solution]).expand()
+            self.skipTest('Linear solvers can be expanded into SX by this version of CasADi')
+        except RuntimeError:
+            pass
+
+        casadi_model = Model()
+        casadi_model.alg_states = list(map(Variable, [x, y]))
+        casadi_model.equations = [x - ca.sin(y[0]), y - solution]
+        ref = casadi_model.dae_residual_function
+
+        # Linear solvers cannot be expanded into SX, and remain in MX.  The
+        # other equations are evaluated by an SX function.
+        casadi_model.simplify({'expand_sx': True})
+        self.assertEqual(casadi_model._sx_outputs['dae_residual'], (2, [0]))
+
+        # The split is not determined again when the function is created
+        def expandable_outputs(*args):
+            raise AssertionError('Expandable outputs determined after simplification')
+        casadi_model._expandable_outputs = expandable_outputs
+        f = casadi_model.dae_residual_function
+        self.assertTrue(f.is_a('MXFunction'))
+        self.assertTrue(casadi_model.variable_metadata_function.is_a('SXFunction'))
+
+        calls = [f.instruction_MX(k).which_function() for k in range(f.n_instructions())
+                 if f.instruction_id(k) == ca.OP_CALL]
+        self.assertEqual([g.name() for g in calls], ['dae_residual_sx'])
+        self.assertTrue(calls[0].is_a('SXFunction'))
+
+        args_in = [0.0, [], [], [0.5, 1.5, 2.5], [], [], []]
+        self.assertTrue(np.allclose(ref.call(args_in)[0], f.call(args_in)[0]))
 
 if __name__ == "__main__":
     unittest.main()
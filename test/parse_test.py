@@ -4,14 +4,18 @@ Modelica parse Tree to AST tree.
 """
 from __future__ import print_function, absolute_import, division, print_function, unicode_literals
 
+import itertools
+import json
 import os
 import sys
+import tempfile
 import time
 import unittest
 
 from pymola import parser
 from pymola import tree
 from pymola import ast
+from pymola.profiler import FlatteningProfiler
 
 TEST_DIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -101,6 +105,18 @@ class ParseTest(unittest.TestCase):
         #     raise IOError('{:s} != {:s}'.format(str(names), str(names_set)))
         self.flush()
 
+    def test_connector_flow_balance(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='Junction'))
+
+        # The flow balance of a connection set is a single n-ary sum
+        balance = flat_tree.classes['Junction'].equations[-1]
+        self.assertEqual(balance.left.operator, '+')
+        self.assertEqual([op.name for op in balance.left.operands], ['a.down.Q', 'b.up.Q', 'c.down.Q', 'd.down.Q'])
+        self.assertEqual(balance.right.value, 0)
+
     def test_inheritance(self):
         with open(os.path.join(TEST_DIR, 'InheritanceInstantiation.mo'), 'r') as f:
             txt = f.read()
@@ -109,6 +125,9 @@ class ParseTest(unittest.TestCase):
 
         self.assertEqual(flat_tree.classes['C2'].symbols['bcomp1.b'].value.value, 3.0)
 
+        # Modifications must leave the modified class definitions untouched
+        self.assertEqual(ast_tree.find_class(ast.ComponentRef(name='A')).symbols['b'].value.value, 0)
+
     def test_nested_classes(self):
         with open(os.path.join(TEST_DIR, 'NestedClasses.mo'), 'r') as f:
             txt = f.read()
@@ -134,6 +153,20 @@ class ParseTest(unittest.TestCase):
 
         self.assertEqual(flat_tree.classes['MainModel'].symbols['e.HQ.H'].min.name, "e.H_b")
 
+    def test_nested_element_modification(self):
+        with open(os.path.join(TEST_DIR, 'ExtendsModification.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        port_class = repr(ast_tree.find_class(ast.ComponentRef(name='HQPort')))
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='TwoPorts'))
+
+        # HQ.H(min = H_b) is applied as HQ(H(min = H_b)), to the component
+        # HQ only, rather than to the definition of its class.
+        symbols = flat_tree.classes['TwoPorts'].symbols
+        self.assertEqual(symbols['e.HQ.H'].min.name, "e.H_b")
+        self.assertIsNone(symbols['p.H'].min.value)
+        self.assertEqual(repr(ast_tree.find_class(ast.ComponentRef(name='HQPort'))), port_class)
+
     def test_tree_lookup(self):
         with open(os.path.join(TEST_DIR, 'TreeLookup.mo'), 'r') as f:
             txt = f.read()
@@ -152,6 +185,275 @@ class ParseTest(unittest.TestCase):
         self.assertIn('elem.tc.a', flat_tree.classes['Test'].symbols.keys())
         self.assertIn('b',         flat_tree.classes['Test'].symbols.keys())
 
+    def test_incremental_flatten(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+
+        # Instances are only recorded when asked for
+        self.assertIsNone(tree.flatten(ast_tree, ast.ComponentRef(name='System')).dependency_graph)
+
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='System'), incremental=True)
+
+        self.assertEqual(flat_tree.dependency_graph.dependencies('hb'), {'HBC', 'HQ'})
+
+        # Change the boundary condition, and only reflatten what depends on it
+        ast_tree = parser.parse(txt.replace('up.H = 0;', 'up.H = 1;'))
+        flat_tree_incremental = tree.flatten(ast_tree, ast.ComponentRef(name='System'),
+                                             previous=flat_tree, changed_classes=['HBC'])
+
+        self.assertEqual(flat_tree_incremental.dependency_graph.reused, ['a', 'b', 'c', 'qa', 'p', 'zerotest'])
+
+        # The reused instances are copies, as the flattened trees are modified in place
+        nodes = set(id(n) for n in itertools.chain(flat_tree.classes['System'].equations,
+                                                    flat_tree.classes['System'].symbols.values()))
+        self.assertFalse(any(id(n) in nodes for n in itertools.chain(
+            flat_tree_incremental.classes['System'].equations,
+            flat_tree_incremental.classes['System'].symbols.values())))
+
+        # A reused instance can be reused again
+        flat_tree_repeated = tree.flatten(ast_tree, ast.ComponentRef(name='System'),
+                                          previous=flat_tree_incremental, changed_classes=['HBC'])
+        self.assertEqual(flat_tree_repeated.dependency_graph.reused, ['a', 'b', 'c', 'qa', 'p', 'zerotest'])
+        self.assertEqual(repr(flat_tree_repeated), repr(flat_tree_incremental))
+
+        # Instances flattened without vectorization are not reused with it
+        flat_tree_vectorized = tree.flatten(ast_tree, ast.ComponentRef(name='System'), previous=flat_tree_incremental,
+                                            changed_classes=[], vectorize_arrays=True)
+        self.assertEqual(flat_tree_vectorized.dependency_graph.reused, [])
+
+        ast_tree = parser.parse(txt.replace('up.H = 0;', 'up.H = 1;'))
+        flat_tree_full = tree.flatten(ast_tree, ast.ComponentRef(name='System'))
+
+        self.assertEqual(repr(flat_tree_incremental), repr(flat_tree_full))
+        self.assertNotEqual(repr(flat_tree_incremental), repr(flat_tree))
+
+    def test_flat_cache(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+
+        with tempfile.TemporaryDirectory() as cache_folder:
+            ast_tree = parser.parse(txt)
+            flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='System'), cache_folder=cache_folder)
+
+            # Adding an unrelated class does not invalidate the cache
+            ast_tree = parser.parse(txt + '\nmodel Unrelated\n  Real x;\nend Unrelated;\n')
+            with self.assertLogs('pymola', level='INFO') as cm:
+                flat_tree_cached = tree.flatten(ast_tree, ast.ComponentRef(name='System'), cache_folder=cache_folder)
+            self.assertIn('from cache', cm.output[0])
+            self.assertEqual(repr(flat_tree_cached), repr(flat_tree))
+
+            # The name table is rebuilt, with the names interned again
+            names = flat_tree_cached.names
+            for name, sym in flat_tree_cached.classes['System'].symbols.items():
+                self.assertIs(sys.intern(name), name)
+                self.assertIs(names.name(sym.id), name)
+                self.assertIs(sym.name, name)
+            self.assertIs(flat_tree_cached.incidence.symbols, names.names)
+            self.assertEqual(flat_tree_cached.incidence.variables(0), flat_tree.incidence.variables(0))
+
+            # Changing a class the model depends on does
+            ast_tree = parser.parse(txt.replace('up.H = 0;', 'up.H = 1;'))
+            flat_tree_changed = tree.flatten(ast_tree, ast.ComponentRef(name='System'), cache_folder=cache_folder)
+            self.assertNotEqual(repr(flat_tree_changed), repr(flat_tree))
+
+            ast_tree = parser.parse(txt.replace('up.H = 0;', 'up.H = 1;'))
+            self.assertEqual(repr(tree.flatten(ast_tree, ast.ComponentRef(name='System'))), repr(flat_tree_changed))
+
+    def test_flatten_profiler(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        profiler = FlatteningProfiler()
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='System'), profiler=profiler)
+        self.assertEqual(repr(flat_tree), repr(tree.flatten(ast_tree, ast.ComponentRef(name='System'))))
+
+        records = {(r.function, r.class_name): r for r in profiler.summary()}
+        self.assertEqual(records['flatten_class', 'System'].calls, 1)
+        self.assertEqual(records['flatten_class', 'Channel'].calls, 3)
+        self.assertEqual(records['expand_connectors', 'System'].calls, 1)
+        # Ten connector instances, and the connector type once more when
+        # expanding the connect clauses
+        self.assertEqual(records['flatten_class', 'HQ'].calls, 11)
+        system = records['flatten_class', 'System']
+        self.assertGreaterEqual(system.inclusive, system.exclusive)
+        self.assertGreater(records['flatten_component_refs', 'HQ'].deepcopies, 0)
+
+        report = profiler.report(sort_by='inclusive').splitlines()
+        self.assertIn('System', report[1])
+
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'profile.json')
+            profiler.save(filename)
+            with open(filename, 'r') as f:
+                self.assertEqual(len(json.load(f)), len(profiler.records))
+
+        # A failing flatten leaves no flattening state behind on the collection
+        with self.assertRaises(ast.ClassNotFoundError):
+            tree.flatten(ast_tree, ast.ComponentRef(name='Missing'), profiler=FlatteningProfiler())
+        self.assertEqual(ast_tree._lookup_logs, [])
+        self.assertIsNone(ast_tree._profiler)
+        self.assertIsNone(ast_tree._flat_functions)
+
+    def test_constant_evaluator(self):
+        with open(os.path.join(TEST_DIR, 'ForLoop.mo'), 'r') as f:
+            txt = f.read()
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='ForLoop'))
+        flat_class = flat_tree.classes['ForLoop']
+
+        evaluator = tree.constant_evaluator(flat_class)
+        self.assertIs(tree.constant_evaluator(flat_class), evaluator)
+        self.assertEqual(evaluator.evaluate(flat_class.symbols['w'].dimensions[1]), 10)
+        self.assertEqual(list(evaluator.evaluate(flat_class.equations[3].indices[0].expression)), [1, 2, 3, 4, 5])
+        self.assertEqual(evaluator.values, {'n': 10})
+
+        size = ast.Expression(operator=ast.ComponentRef(name='size'),
+                              operands=[ast.ComponentRef(name='w'), ast.Primary(value=1)])
+        self.assertEqual(evaluator.evaluate(size), 2)
+        index = ast.Expression(operator='+', operands=[ast.ComponentRef(name='k'), ast.ComponentRef(name='n')])
+        self.assertEqual(evaluator.evaluate(index, {'k': 3}), 13)
+
+        # Variables are not structural parameters
+        with self.assertRaises(tree.ConstantEvaluationError):
+            evaluator.evaluate(ast.ComponentRef(name='b'))
+
+    def test_pruned_walk(self):
+        self.assertEqual(tree.descendant_types(ast.Primary), set())
+        self.assertIn(ast.Expression, tree.descendant_types(ast.Symbol))
+        self.assertNotIn(ast.Equation, tree.descendant_types(ast.Symbol))
+        self.assertIsNone(tree.descendant_types(ast.Class))
+
+        class NodeCounter(tree.TreeListener):
+            def __init__(self):
+                self.visited = []
+                super().__init__()
+
+            def enterEvery(self, tree):
+                self.visited.append(type(tree))
+
+        class ComponentRefCollector(tree.TreeListener):
+            def __init__(self):
+                self.refs = []
+                super().__init__()
+
+            def enterComponentRef(self, tree):
+                self.refs.append(tree.name)
+
+        with open(os.path.join(TEST_DIR, 'Spring.mo'), 'r') as f:
+            txt = f.read()
+        flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name='Spring'))
+
+        # Listeners handling every node visit every node
+        counter = NodeCounter()
+        tree.TreeWalker().walk(counter, flat_tree)
+        self.assertIn(ast.Primary, counter.visited)
+
+        # Primary leaves cannot contain component references, and are skipped
+        collector = ComponentRefCollector()
+        self.assertFalse(tree.must_visit(ComponentRefCollector, ast.Primary))
+        self.assertTrue(tree.must_visit(ComponentRefCollector, ast.Symbol))
+        tree.TreeWalker().walk(collector, flat_tree)
+        self.assertIn('x', collector.refs)
+        self.assertEqual(collector.refs.count('Real'), len(flat_tree.classes['Spring'].symbols))
+
+    def test_iter_flatten(self):
+        for mo_file, class_name in [('ConnectorHQ.mo', 'System'), ('FunctionShared.mo', 'Points')]:
+            with open(os.path.join(TEST_DIR, mo_file), 'r') as f:
+                txt = f.read()
+            flat_tree = tree.flatten(parser.parse(txt), ast.ComponentRef(name=class_name))
+            flat_class = flat_tree.classes[class_name]
+
+            elements = list(tree.iter_flatten(parser.parse(txt), ast.ComponentRef(name=class_name)))
+            self.assertEqual(elements[0].kind, 'class')
+            streamed_class = elements[0].node
+            self.assertEqual(streamed_class.equations, [])
+
+            # Every element is yielded once, and symbols come before the equations of their component
+            symbols = [e.name for e in elements if e.kind == 'symbol']
+            self.assertEqual(sorted(symbols), sorted(flat_class.symbols.keys()))
+            self.assertEqual(list(streamed_class.symbols.keys()), list(flat_class.symbols.keys()))
+            for sym in streamed_class.symbols.values():
+                self.assertEqual(sym.prefixes, flat_class.symbols[sym.name].prefixes)
+                self.assertEqual(repr(sym.value), repr(flat_class.symbols[sym.name].value))
+            functions = [e.name for e in elements if e.kind == 'function']
+            self.assertEqual(sorted(functions), sorted(n for n in flat_tree.classes.keys() if n != class_name))
+            self.assertLess(min(i for i, e in enumerate(elements) if e.kind == 'symbol'),
+                            min(i for i, e in enumerate(elements) if e.kind == 'equation'))
+
+            # Equations that embed a symbol show its id
+            tree.assign_symbol_ids(streamed_class)
+            equations = [repr(e.node) for e in elements if e.kind == 'equation']
+            self.assertEqual(sorted(equations), sorted(repr(e) for e in flat_class.equations))
+
+    def test_incidence(self):
+        with open(os.path.join(TEST_DIR, 'Spring.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='Spring'))
+
+        incidence = flat_tree.incidence
+        self.assertEqual(len(incidence), 2)
+        self.assertEqual(incidence.variables(0), ['x', 'v_x'])
+        self.assertEqual(incidence.variables(0, derivative=True), ['x'])
+        self.assertEqual(incidence.variables(1, derivative=True), ['v_x'])
+        self.assertEqual(incidence.variables(1, derivative=False), ['x', 'v_x', 'c', 'k'])
+        self.assertEqual(len(flat_tree.initial_incidence), 0)
+
+    def test_symbol_ids(self):
+        with open(os.path.join(TEST_DIR, 'ConnectorHQ.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='System'))
+
+        symbols = flat_tree.classes['System'].symbols
+        names = flat_tree.names
+        self.assertEqual(len(names), len(symbols))
+        self.assertEqual(sorted(sym.id for sym in symbols.values()), list(range(len(symbols))))
+        for name, sym in symbols.items():
+            self.assertEqual(names.name(sym.id), name)
+            self.assertEqual(names.id(name), sym.id)
+
+        # Incidence entries are symbol ids
+        self.assertIs(flat_tree.incidence.symbols, names.names)
+        self.assertIn(names.id('p.Q'), flat_tree.incidence.indices)
+
+    def test_prune_collection(self):
+        with open(os.path.join(TEST_DIR, 'FunctionPull.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+
+        comp_ref = ast.ComponentRef.from_string('Level1.Level2.Level3.Function5')
+        pruned_tree = tree.prune_collection(ast_tree, comp_ref)
+
+        # Only the model, and the functions it calls directly or indirectly, remain
+        package = pruned_tree.find_class(ast.ComponentRef.from_string('Level1.Level2.Level3.TestPackage'))
+        self.assertEqual(list(package.classes.keys()), ['times2', 'square'])
+        self.assertEqual(len(ast_tree.files[0].classes['TestPackage'].classes), 3)
+
+        self.assertEqual(repr(tree.flatten(pruned_tree, comp_ref)), repr(tree.flatten(ast_tree, comp_ref)))
+
+    def test_dead_element_elimination(self):
+        with open(os.path.join(TEST_DIR, 'DeadElements.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='DeadElements'))
+        self.assertIsNone(flat_tree.pruned)
+        self.assertIn('square', flat_tree.classes)
+
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='DeadElements'), prune_dead_elements=True)
+        self.assertEqual(flat_tree.pruned.symbols, ['unused', 'c_unused', 'p_unused'])
+        self.assertEqual(flat_tree.pruned.functions, ['square'])
+        self.assertNotIn('square', flat_tree.classes)
+
+        # Parameters referred to by dimensions and attributes of live symbols remain
+        self.assertEqual(list(flat_tree.classes['DeadElements'].symbols.keys()),
+                         ['n', 'k', 'x_start', 'x', 'y', 'p_bound'])
+
+        # The equation for the value of a symbol refers to that symbol
+        incidence = flat_tree.incidence
+        self.assertEqual(incidence.variables(2), ['p_bound'])
+
     def test_function_pull(self):
         with open(os.path.join(TEST_DIR, 'FunctionPull.mo'), 'r') as f:
             txt = f.read()
@@ -187,5 +489,23 @@ class ParseTest(unittest.TestCase):
         self.assertEqual(func_f.statements[0].right.operands[0].operator,
                          'Level1.Level2.Level3.TestPackage.times2')
 
+    def test_function_pull_shared(self):
+        with open(os.path.join(TEST_DIR, 'FunctionShared.mo'), 'r') as f:
+            txt = f.read()
+        ast_tree = parser.parse(txt)
+
+        profiler = FlatteningProfiler()
+        flat_tree = tree.flatten(ast_tree, ast.ComponentRef(name='Points'), profiler=profiler)
+
+        # Functions called from declarations, also inside functions, are pulled in
+        self.assertIn('SharedFunctions.norm', flat_tree.classes)
+        self.assertIn('SharedFunctions.square', flat_tree.classes)
+        self.assertEqual(flat_tree.classes['Points'].equations[0].right.operator, 'SharedFunctions.norm')
+
+        # Every function is flattened only once, even though three instances call it
+        records = {(r.function, r.class_name): r for r in profiler.summary()}
+        self.assertEqual(records['flatten_class', 'norm'].calls, 1)
+        self.assertEqual(records['flatten_class', 'square'].calls, 1)
+
 if __name__ == "__main__":
     unittest.main()